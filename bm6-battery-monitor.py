@@ -31,6 +31,7 @@ MAX_RETRIES = 3
 RETRY_DELAY_BASE = 1.0  # Base delay in seconds
 DATA_TIMEOUT = 10  # Timeout for data retrieval in seconds
 BLE_CONNECTION_TIMEOUT = 30  # Timeout for BLE connection in seconds
+SCAN_TIMEOUT = 5  # Duration of a device scan in seconds
 
 # MAC address validation pattern
 MAC_ADDRESS_PATTERN = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
@@ -103,21 +104,25 @@ async def scan_bm6(format: str) -> None:
     Args:
         format: Output format ('ascii' or 'json')
     """
-    logger.debug("Starting BM6 device scan with 5 second timeout")
-    device_list: List[Tuple[str, int]] = []
-    
+    logger.debug(f"Starting BM6 device scan with {SCAN_TIMEOUT} second timeout")
+    found: Dict[str, int] = {}  # address -> latest RSSI
+
+    def detection_callback(device, advertisement_data) -> None:
+        # Keep only BM6 advertisements; everything else is dropped right here
+        if (advertisement_data.local_name or device.name) == "BM6":
+            found[device.address] = advertisement_data.rssi
+
     try:
-        scan = await BleakScanner.discover(return_adv=True, timeout=5)
-        logger.debug(f"Scan completed, found {len(scan)} total devices")
+        # The context manager starts the scanner and stops it again on exit
+        async with BleakScanner(detection_callback=detection_callback):
+            await asyncio.sleep(SCAN_TIMEOUT)
     except Exception as e:
         logger.error(f"Failed to scan for devices: {e}")
         raise
 
-    # Filter only BM6 devices
-    for device in scan.values():
-        if device[0].name == "BM6":
-            device_list.append((device[0].address, device[1].rssi))
-            logger.debug(f"Found BM6 device: {device[0].address} (RSSI: {device[1].rssi})")
+    device_list: List[Tuple[str, int]] = list(found.items())
+    for address, rssi in device_list:
+        logger.debug(f"Found BM6 device: {address} (RSSI: {rssi})")
 
     logger.info(f"Found {len(device_list)} BM6 devices")
 
@@ -0,0 +1,42 @@
+# BM6 BLE - Shared command/response helpers for the BM6 test scripts.
+# Commands are written to FFF3 and answered by notifications on FFF4; these
+# wait for a reply and its trailing packets instead of sleeping a fixed time.
+
+import asyncio
+from bleak.uuids import normalize_uuid_str
+
+def supports_write_without_response(client):
+    """True when FFF3 accepts write-without-response, which skips the ATT ack round trip"""
+    char = client.services.get_characteristic(normalize_uuid_str("fff3"))
+    return char is not None and "write-without-response" in char.properties
+
+async def wait_for_responses(event, wait_time, quiet_period):
+    """Wait for a reply and its trailing packets, up to wait_time seconds
+
+    Returns once quiet_period passes without a new response after the first
+    one, so a prompt device costs far less than the full wait_time.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait_time
+    timeout = wait_time
+    try:
+        while timeout > 0:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+            event.clear()
+            timeout = min(quiet_period, deadline - loop.time())
+    except asyncio.TimeoutError:
+        pass
+
+async def write_and_wait(client, encrypted, event, wait_time, quiet_period, response=True):
+    """Write a command and wait for its responses, counted from when the write starts
+
+    If the write fails the waiter is cancelled, so it can't consume the event
+    meant for the next command.
+    """
+    event.clear()
+    waiter = asyncio.create_task(wait_for_responses(event, wait_time, quiet_period))
+    try:
+        await client.write_gatt_char("FFF3", encrypted, response=response)
+        await waiter
+    finally:
+        waiter.cancel()
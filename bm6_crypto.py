@@ -0,0 +1,51 @@
+# BM6 Crypto - Shared AES helpers for the BM6 test scripts
+# Packets are a single 16-byte block, where CBC with a zero IV is identical
+# to ECB, so one cipher context per direction is built once and reused.
+
+# BM6 encryption key
+BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+
+# Use the cryptography package when installed (its contexts are OpenSSL EVP
+# cipher contexts, so each call is a single EVP update), else pycryptodome.
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+    from Crypto.Cipher import AES
+
+def make_ecb(key):
+    """Return reusable (encrypt, decrypt) functions for whole-block AES with key
+
+    Input that isn't a multiple of 16 bytes raises ValueError, as it does with
+    pycryptodome.
+    """
+    if Cipher is not None:
+        cipher = Cipher(algorithms.AES(bytes(key)), modes.ECB())
+        # The contexts are never finalized, so a partial block would be
+        # buffered and shift every later call; whole blocks leave nothing behind
+        encrypt_blocks, decrypt_blocks = cipher.encryptor().update, cipher.decryptor().update
+    else:
+        ecb = AES.new(bytes(key), AES.MODE_ECB)
+        encrypt_blocks, decrypt_blocks = ecb.encrypt, ecb.decrypt
+
+    def encrypt(data):
+        if len(data) % 16:
+            raise ValueError(f"AES input must be a multiple of 16 bytes, got {len(data)}")
+        return encrypt_blocks(data)
+
+    def decrypt(data):
+        if len(data) % 16:
+            raise ValueError(f"AES input must be a multiple of 16 bytes, got {len(data)}")
+        return decrypt_blocks(data)
+
+    return encrypt, decrypt
+
+_encrypt_block, _decrypt_block = make_ecb(BM6_KEY)
+
+def decrypt_bm6(crypted):
+    """Decrypt data using BM6 key"""
+    return _decrypt_block(crypted)
+
+def encrypt_bm6(plaintext):
+    """Encrypt data using BM6 key"""
+    return _encrypt_block(plaintext)
@@ -0,0 +1,122 @@
+# BM6 Parse - Shared response parsers for the BM6 test scripts.
+# Responses are handled as the hex strings the scripts print, and decoded to
+# bytes once per call so every 16-bit window is read with bulk struct unpacks.
+
+import struct
+
+def unpack_windows(buf, code):
+    """Value of struct format `code` (e.g. '>H', '<I') at every byte offset of buf"""
+    size = struct.calcsize(code)
+    n = len(buf) - size + 1
+    if n < 1:
+        return []
+    # One C-level unpack per alignment phase instead of one parse per offset
+    values = [0] * n
+    for phase in range(min(size, n)):
+        count = (n - phase + size - 1) // size
+        values[phase::size] = struct.unpack_from(f'{code[0]}{count}{code[1]}', buf, phase)
+    return values
+
+def find_voltage_values(hex_data):
+    """Find all potential voltage values in hex data"""
+    voltage_candidates = []
+    
+    # Decode once, then read every 16-bit window both ways in bulk; dicts are
+    # only built for the few values in range
+    raw = bytes.fromhex(hex_data)
+    for offset, (val16_be, val16_le) in enumerate(zip(unpack_windows(raw, '>H'), unpack_windows(raw, '<H'))):
+        if 600 <= val16_be <= 2000:  # 6.0V to 20.0V
+            i = 2 * offset
+            voltage_candidates.append({
+                'position': i,
+                'raw_value': val16_be,
+                'voltage': val16_be / 100.0,
+                'bytes': hex_data[i:i+4],
+                'endian': 'big'
+            })
+        if 600 <= val16_le <= 2000:
+            i = 2 * offset
+            voltage_candidates.append({
+                'position': i,
+                'raw_value': val16_le,
+                'voltage': val16_le / 100.0,
+                'bytes': hex_data[i:i+4],
+                'endian': 'little'
+            })
+    
+    return voltage_candidates
+
+def quick_parse(hex_data):
+    """Only the voltage candidates of a response, which is all the tests read"""
+    return {'voltage_candidates': find_voltage_values(hex_data)}
+
+def parse_response_detailed(hex_data):
+    """Detailed parsing of response data"""
+    # Analyze individual bytes (first 16), decoding the hex once
+    byte_analysis = [{
+        'position': 2 * i,
+        'hex': f'{byte_val:02x}',
+        'decimal': byte_val,
+        'ascii': chr(byte_val) if 32 <= byte_val <= 126 else '.'
+    } for i, byte_val in enumerate(bytes.fromhex(hex_data[:32]))]
+    
+    analysis = {
+        'length': len(hex_data),
+        'prefix': hex_data[:8] if len(hex_data) >= 8 else hex_data,
+        'full_data': hex_data,
+        'voltage_candidates': find_voltage_values(hex_data),
+        'byte_analysis': byte_analysis
+    }
+    
+    return analysis
+
+def parse_voltage_data(hex_data):
+    """Try to parse hex data as voltage/temperature like standard BM6 format"""
+    if len(hex_data) < 18:
+        return None
+    
+    # Decode once and work on byte values instead of hex substrings
+    try:
+        raw = bytes.fromhex(hex_data)
+    except ValueError:
+        return None
+    
+    # Standard BM6 voltage parsing
+    if raw.startswith(b'\xd1\x55\x07'):
+        # 12 bits: low nibble of byte 7 and byte 8 (hex digits 15-17)
+        voltage = (((raw[7] & 0x0f) << 8) | raw[8]) / 100.0
+        if raw[3] == 0x01:
+            temperature = -raw[4]
+        else:
+            temperature = raw[4]
+        soc = raw[6]
+        
+        return {
+            'voltage': voltage,
+            'temperature': temperature, 
+            'soc': soc,
+            'format': 'standard'
+        }
+
+    # Counter (0A) echoes carry no voltage; skip the scan for them
+    if raw.startswith(b'\xd1\x55\x0a'):
+        return None
+
+    # Try alternative voltage formats: 16-bit values that might be
+    # voltage * 100, read in bulk (the final window is not considered)
+    voltage_candidates = []
+    for j, val16 in enumerate(unpack_windows(raw, '>H')[:-1]):
+        if 600 <= val16 <= 2000:  # 6.0V to 20.0V
+            voltage_candidates.append({
+                'position': 2 * j,
+                'raw_value': val16,
+                'voltage': val16 / 100.0
+            })
+    
+    if voltage_candidates:
+        return {
+            'voltage_candidates': voltage_candidates,
+            'format': 'alternative'
+        }
+    
+    return None
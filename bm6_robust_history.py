@@ -5,10 +5,10 @@
 
 import argparse
 import asyncio
-import time
 import json
+from collections import deque
 from datetime import datetime, timedelta
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from typing import List, Optional, Dict, Any
 from Crypto.Cipher import AES
 from bleak import BleakClient, BleakScanner
@@ -16,7 +16,11 @@ from bleak import BleakClient, BleakScanner
 # BM6 encryption key
 BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
 
-@dataclass
+# Once a command's reply has arrived, keep collecting trailing packets (command
+# 05 sends several) until this long passes without a new one
+REPLY_QUIET_PERIOD = 0.2
+
+@dataclass(slots=True)
 class HistoryReading:
     """Historical voltage reading from BM6"""
     voltage: float
@@ -30,9 +34,16 @@ class HistoryReading:
 
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary for JSON export"""
-        data = asdict(self)
-        data['timestamp'] = self.timestamp.isoformat()
-        return data
+        return {
+            'voltage': self.voltage,
+            'timestamp': self.timestamp.isoformat(),
+            'raw_data': self.raw_data,
+            'source_command': self.source_command,
+            'record_index': self.record_index,
+            'confidence': self.confidence,
+            'temperature': self.temperature,
+            'soc': self.soc
+        }
 
 def decrypt_bm6(crypted):
     cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
@@ -80,12 +91,23 @@ class BM6RobustHistoryClient:
     def __init__(self, address: str):
         self.address = address
         self.client = None
-        self.responses = []
+        self.responses = deque(maxlen=256)
         self.connected = False
+        # Reference points for mapping loop (monotonic) time back to wall time;
+        # taken on connect, from the loop that delivers the notifications
+        self._loop_ref_real = None
+        self._loop_ref_mono = None
+        # Set by the notification handler when the pending command is answered
+        self._reply_event = asyncio.Event()
+        self._expected_prefix = ''
+        # Set on every notification, to detect when trailing packets stop
+        self._packet_event = asyncio.Event()
         
     async def find_and_connect(self, max_attempts: int = 3) -> bool:
         """Find device and connect with retry logic"""
         print(f"🔍 Scanning for BM6 device {self.address}...")
+        self._loop_ref_real = datetime.now()
+        self._loop_ref_mono = asyncio.get_running_loop().time()
         
         for attempt in range(max_attempts):
             try:
@@ -168,9 +190,13 @@ class BM6RobustHistoryClient:
                 pass
         self.connected = False
     
+    def _to_datetime(self, loop_time: float) -> datetime:
+        """Convert an event loop timestamp to a wall-clock datetime"""
+        return self._loop_ref_real + timedelta(seconds=loop_time - self._loop_ref_mono)
+    
     async def _notification_handler(self, sender, data):
         """Handle BLE notifications"""
-        timestamp = time.time()
+        timestamp = asyncio.get_running_loop().time()
         decrypted = decrypt_bm6(data)
         
         self.responses.append({
@@ -178,6 +204,10 @@ class BM6RobustHistoryClient:
             'raw': data.hex(),
             'decrypted': decrypted
         })
+        
+        self._packet_event.set()
+        if self._expected_prefix and decrypted.startswith(self._expected_prefix):
+            self._reply_event.set()
     
     async def _send_command_safe(self, command_hex: str, wait_time: float = 3.0) -> List[dict]:
         """Send command safely with connection checking"""
@@ -188,19 +218,37 @@ class BM6RobustHistoryClient:
                 return []
         
         self.responses.clear()
+        self._expected_prefix = command_hex[:6]
+        self._reply_event.clear()
         
         try:
             command_bytes = bytearray.fromhex(command_hex)
             encrypted = encrypt_bm6(command_bytes)
             
             await self.client.write_gatt_char("FFF3", encrypted, response=True)
-            await asyncio.sleep(wait_time)
             
-            return self.responses.copy()
+            # Return once the reply and its trailing packets have arrived;
+            # wait_time is now the upper bound
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + wait_time
+            try:
+                await asyncio.wait_for(self._reply_event.wait(), timeout=wait_time)
+                while (remaining := deadline - loop.time()) > 0:
+                    self._packet_event.clear()
+                    await asyncio.wait_for(self._packet_event.wait(),
+                                           timeout=min(REPLY_QUIET_PERIOD, remaining))
+            except asyncio.TimeoutError:
+                pass
+            
+            return list(self.responses)
             
         except Exception as e:
             print(f"⚠️  Command {command_hex[:12]}... failed: {e}")
             return []
+        finally:
+            # A late or duplicate packet must not count as the next command's reply
+            self._expected_prefix = ''
+            self._reply_event.clear()
     
     async def get_current_data(self) -> Optional[dict]:
         """Get current voltage, temperature, and SoC"""
@@ -221,7 +269,7 @@ class BM6RobustHistoryClient:
                         'voltage': voltage,
                         'temperature': temperature,
                         'soc': soc,
-                        'timestamp': datetime.fromtimestamp(response['timestamp'])
+                        'timestamp': self._to_datetime(response['timestamp'])
                     }
                 except:
                     continue
@@ -6,24 +6,100 @@
 import argparse
 import asyncio
 import time
-import json
-from datetime import datetime, timedelta
+import struct
+from itertools import groupby
+from datetime import datetime
 from Crypto.Cipher import AES
 from bleak import BleakClient
+from bm6_ble import wait_for_responses
+from bm6_parse import unpack_windows
 
 # BM6 encryption key
 BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
 
+# BM6 frames are a single 16-byte block, and CBC with a zero IV over one
+# block is plain ECB, so one stateless cipher object can be reused for
+# every packet instead of re-running the key schedule per call.
+_KEY = bytes(BM6_KEY)
+_ENC_CIPHER = AES.new(_KEY, AES.MODE_ECB)
+_DEC_CIPHER = AES.new(_KEY, AES.MODE_ECB)
+
 def decrypt_bm6(crypted):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.decrypt(crypted).hex()
+    return _DEC_CIPHER.decrypt(crypted)
 
 def encrypt_bm6(plaintext):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.encrypt(plaintext)
+    return _ENC_CIPHER.encrypt(plaintext)
+
+# Once a reply starts arriving, stop waiting after this much silence
+RESPONSE_QUIET_PERIOD = 0.3
+
+# Inter-command gap is RTT_GAP_FACTOR x the smoothed reply time, never below
+# MIN_COMMAND_GAP; RTT_SMOOTHING is the weight given to each new sample
+RTT_GAP_FACTOR = 1.5
+RTT_SMOOTHING = 0.25
+MIN_COMMAND_GAP = 0.03
+INITIAL_RTT = 0.2
+
+# Maximum number of command results remembered by the command cache
+COMMAND_CACHE_SIZE = 512
+
+# Header of every d155 command: d1 55 <cmd>, remaining 13 bytes zeroed
+_COMMAND_HEADER = struct.Struct('>BBB13x')
+
+def encode_command(cmd, fmt='', values=(), offset=4):
+    """16-byte command d1 55 <cmd>, with `values` packed as `fmt` at `offset`"""
+    buf = bytearray(_COMMAND_HEADER.pack(0xd1, 0x55, cmd))
+    if fmt:
+        struct.pack_into(fmt, buf, offset, *values)
+    return bytes(buf)
+
+# Parameterless command for every command byte, as swept by Phase 1
+PHASE1_COMMANDS = [encode_command(cmd) for cmd in range(256)]
+
+# Phase 2 strategies: (name, parameter tuples, parameter format at byte 4)
+PARAMETER_STRATEGIES = [
+    # Record index patterns
+    ("Record Index", [(i,) for i in range(0, 100, 10)], '>H'),
+    
+    # Time-based patterns (minutes/hours ago)
+    ("Time Offset (min)", [(15*i,) for i in range(1, 20)], '>H'),  # Every 15 minutes for ~5 hours
+    
+    # Date-based patterns (days since reference)
+    ("Date Offset", [(i,) for i in range(1, 8)], '>H'),  # Last 7 days
+    
+    # Record count requests
+    ("Record Count", [(n,) for n in [1, 5, 10, 20, 50, 100]], '>H'),
+    
+    # Range requests (start, count)
+    ("Range Request", [(0, 10), (10, 10), (20, 10), (0, 50), (50, 50)], 'BB'),
+]
+
+# Likely history commands probed by --quick
+QUICK_COMMANDS = [
+    # Most likely based on embedded systems patterns
+    (bytes.fromhex("d1550600000000000000000000000000"), "Command 06 - History List"),
+    (bytes.fromhex("d1550800000000000000000000000000"), "Command 08 - History Data"),
+    (bytes.fromhex("d1551000000000000000000000000000"), "Command 10 - Extended History"),
+    (bytes.fromhex("d1552000000000000000000000000000"), "Command 20 - Bulk History"),
+    (bytes.fromhex("d1558000000000000000000000000000"), "Command 80 - System History"),
+    
+    # Parameter variations of promising commands
+    (bytes.fromhex("d1550600010000000000000000000000"), "Command 06 with param 01"),
+    (bytes.fromhex("d1550600100000000000000000000000"), "Command 06 with param 10"),
+    (bytes.fromhex("d1550800010000000000000000000000"), "Command 08 with param 01"),
+    (bytes.fromhex("d1550800100000000000000000000000"), "Command 08 with param 10"),
+    
+    # Range-based requests
+    (bytes.fromhex("d1550600006400000000000000000000"), "Command 06 - request 100 records"),
+    (bytes.fromhex("d1550800006400000000000000000000"), "Command 08 - request 100 records"),
+]
 
-def analyze_response_for_history(hex_data):
-    """Analyze response for historical data patterns"""
+def analyze_response_for_history(buf):
+    """Analyze a decrypted response for historical data patterns
+    
+    Positions are reported as hex-string offsets (2 per byte). Timestamps are
+    raw unix seconds; convert with datetime.fromtimestamp only when displayed.
+    """
     analysis = {
         'voltages': [],
         'timestamps': [],
@@ -32,45 +108,32 @@ def analyze_response_for_history(hex_data):
     }
     
     # Look for voltage patterns
-    for i in range(0, len(hex_data) - 3, 2):
-        try:
-            val = int(hex_data[i:i+4], 16)
-            if 600 <= val <= 2000:  # 6.0V to 20.0V
-                voltage = val / 100.0
-                analysis['voltages'].append({
-                    'voltage': voltage,
-                    'position': i,
-                    'raw': hex_data[i:i+4]
-                })
-        except:
-            continue
+    for j, val in enumerate(unpack_windows(buf, '>H')):
+        if 600 <= val <= 2000:  # 6.0V to 20.0V
+            analysis['voltages'].append({
+                'voltage': val / 100.0,
+                'position': j * 2,
+                'raw': buf[j:j+2]
+            })
     
     # Look for timestamp patterns (32-bit unix timestamps)
-    current_time = int(time.time())
-    for i in range(0, len(hex_data) - 7, 2):
-        try:
-            # Try big-endian 32-bit timestamp
-            ts_be = int(hex_data[i:i+8], 16)
-            if 1600000000 <= ts_be <= current_time + 86400:
-                analysis['timestamps'].append({
-                    'timestamp': ts_be,
-                    'datetime': datetime.fromtimestamp(ts_be),
-                    'position': i,
-                    'format': 'be32'
-                })
-            
-            # Try little-endian 32-bit timestamp
-            ts_le_hex = hex_data[i+6:i+8] + hex_data[i+4:i+6] + hex_data[i+2:i+4] + hex_data[i:i+2]
-            ts_le = int(ts_le_hex, 16)
-            if 1600000000 <= ts_le <= current_time + 86400:
-                analysis['timestamps'].append({
-                    'timestamp': ts_le,
-                    'datetime': datetime.fromtimestamp(ts_le),
-                    'position': i,
-                    'format': 'le32'
-                })
-        except:
-            continue
+    max_timestamp = int(time.time()) + 86400
+    for j, (ts_be, ts_le) in enumerate(zip(unpack_windows(buf, '>I'), unpack_windows(buf, '<I'))):
+        # Try big-endian 32-bit timestamp
+        if 1600000000 <= ts_be <= max_timestamp:
+            analysis['timestamps'].append({
+                'timestamp': ts_be,
+                'position': j * 2,
+                'format': 'be32'
+            })
+        
+        # Try little-endian 32-bit timestamp
+        if 1600000000 <= ts_le <= max_timestamp:
+            analysis['timestamps'].append({
+                'timestamp': ts_le,
+                'position': j * 2,
+                'format': 'le32'
+            })
     
     # Estimate record structure
     if len(analysis['voltages']) > 1:
@@ -81,11 +144,64 @@ def analyze_response_for_history(hex_data):
     
     return analysis
 
+def analyze_counts_only(buf):
+    """Count voltage and timestamp candidates without building the full analysis
+    
+    Fast path for scoring; matches the list lengths of analyze_response_for_history.
+    """
+    n_voltages = 0
+    for val in unpack_windows(buf, '>H'):
+        if 600 <= val <= 2000:
+            n_voltages += 1
+    
+    n_timestamps = 0
+    max_timestamp = int(time.time()) + 86400
+    for ts_be, ts_le in zip(unpack_windows(buf, '>I'), unpack_windows(buf, '<I')):
+        if 1600000000 <= ts_be <= max_timestamp:
+            n_timestamps += 1
+        if 1600000000 <= ts_le <= max_timestamp:
+            n_timestamps += 1
+    
+    return n_voltages, n_timestamps
+
+def total_counts(responses):
+    """Total (voltages, timestamps) candidate counts over stored responses"""
+    total_voltages = 0
+    total_timestamps = 0
+    for resp in responses:
+        n_voltages, n_timestamps = resp['counts']
+        total_voltages += n_voltages
+        total_timestamps += n_timestamps
+    return total_voltages, total_timestamps
+
+def full_analysis(response):
+    """Full analysis of a stored response, computed on first use"""
+    analysis = response.get('analysis')
+    if analysis is None:
+        analysis = analyze_response_for_history(response['decrypted'])
+        response['analysis'] = analysis
+    return analysis
+
 class BM6TargetedHistoryClient:
-    def __init__(self, address):
+    def __init__(self, address, use_cache=True):
         self.address = address
         self.client = None
+        self.use_cache = use_cache
+        # Responses per 16-byte plaintext command, evicted oldest-first
+        self._cmd_cache = {}
+        # Every packet for the current command; cleared before each command so
+        # long multi-record replies are kept whole
         self.responses = []
+        # Scratch buffer the encrypted command is written into
+        self._enc_buf = bytearray(16)
+        # Set by the notification handler whenever a packet arrives
+        self._response_event = asyncio.Event()
+        # Scan-loop output, printed in one write per command range
+        self._log = []
+        # Smoothed time from write completion to the last reply packet
+        self._rtt = INITIAL_RTT
+        self._last_packet_time = 0.0
+        self._last_command_sent = False
         
     async def connect(self):
         self.client = BleakClient(self.address, timeout=30)
@@ -98,26 +214,57 @@ class BM6TargetedHistoryClient:
             await self.client.disconnect()
     
     async def _notification_handler(self, sender, data):
-        timestamp = time.time()
         decrypted = decrypt_bm6(data)
         self.responses.append({
-            'timestamp': timestamp,
-            'raw': data.hex(),
-            'decrypted': decrypted
+            'raw': bytes(data),
+            'decrypted': decrypted,
+            # (voltages, timestamps) candidate counts; the full analysis is
+            # only built via full_analysis() for responses that have any
+            'counts': analyze_counts_only(decrypted)
         })
+        self._last_packet_time = asyncio.get_running_loop().time()
+        self._response_event.set()
     
-    async def send_command(self, command_hex, wait_time=3.0):
+    async def send_command(self, command, wait_time=3.0):
+        key = bytes(command)
+        if self.use_cache and key in self._cmd_cache:
+            self._last_command_sent = False
+            return self._cmd_cache[key]
+        
         self.responses.clear()
+        self._response_event.clear()
+        self._last_command_sent = True
         try:
-            command_bytes = bytearray.fromhex(command_hex)
-            encrypted = encrypt_bm6(command_bytes)
-            await self.client.write_gatt_char("FFF3", encrypted, response=True)
-            await asyncio.sleep(wait_time)
-            return self.responses.copy()
+            _ENC_CIPHER.encrypt(command, output=self._enc_buf)
+            await self.client.write_gatt_char("FFF3", self._enc_buf, response=True)
+            write_done = asyncio.get_running_loop().time()
+            await wait_for_responses(self._response_event, wait_time, RESPONSE_QUIET_PERIOD)
+            responses = tuple(self.responses)
+            
+            if responses:
+                sample = max(self._last_packet_time - write_done, 0.0)
+                self._rtt += RTT_SMOOTHING * (sample - self._rtt)
+            
+            if self.use_cache:
+                if len(self._cmd_cache) >= COMMAND_CACHE_SIZE:
+                    del self._cmd_cache[next(iter(self._cmd_cache))]
+                self._cmd_cache[key] = responses
+            return responses
         except Exception as e:
             print(f"⚠️  Command failed: {e}")
             return []
     
+    def _flush_log(self):
+        """Print buffered scan-loop lines in a single write"""
+        if self._log:
+            print("\n".join(self._log))
+            self._log.clear()
+    
+    async def _pace(self):
+        """Pause between commands, scaled to the device's observed reply time"""
+        if self._last_command_sent:
+            await asyncio.sleep(max(self._rtt * RTT_GAP_FACTOR, MIN_COMMAND_GAP))
+    
     async def test_comprehensive_history_commands(self):
         """Test comprehensive set of history-related commands"""
         
@@ -143,38 +290,33 @@ class BM6TargetedHistoryClient:
             print(f"\n  {description} ({start:02x}-{end-1:02x}):")
             
             for cmd in range(start, min(end, 256)):
-                command = f"d155{cmd:02x}00000000000000000000000000"
-                print(f"    Testing {cmd:02x}: ", end="")
+                command = PHASE1_COMMANDS[cmd]
                 
                 responses = await self.send_command(command, 2.0)
                 
                 if responses:
                     # Analyze for history content
-                    total_voltages = 0
-                    total_timestamps = 0
-                    
-                    for resp in responses:
-                        analysis = analyze_response_for_history(resp['decrypted'])
-                        total_voltages += len(analysis['voltages'])
-                        total_timestamps += len(analysis['timestamps'])
+                    total_voltages, total_timestamps = total_counts(responses)
                     
                     if total_voltages > 0 or total_timestamps > 0:
-                        print(f"✅ {len(responses)} resp, V:{total_voltages}, T:{total_timestamps}")
+                        self._log.append(f"    Testing {cmd:02x}: ✅ {len(responses)} resp, V:{total_voltages}, T:{total_timestamps}")
                         all_findings.append({
                             'command': cmd,
-                            'base_command': command,
+                            'base_command': command.hex(),
                             'responses': len(responses),
                             'voltages': total_voltages,
                             'timestamps': total_timestamps,
                             'priority': 'high' if total_voltages > 2 or total_timestamps > 0 else 'medium'
                         })
                     else:
-                        print(f"{len(responses)} resp")
+                        self._log.append(f"    Testing {cmd:02x}: {len(responses)} resp")
                 else:
-                    print("No response")
+                    self._log.append(f"    Testing {cmd:02x}: No response")
                 
                 # Small delay to avoid overwhelming
-                await asyncio.sleep(0.3)
+                await self._pace()
+            
+            self._flush_log()
         
         # Phase 2: Parameter-based history retrieval for promising commands
         print(f"\n📋 Phase 2: Parameter-Based History Retrieval")
@@ -189,49 +331,23 @@ class BM6TargetedHistoryClient:
             print(f"\n  Command {cmd:02x} parameter variations:")
             
             # Test different parameter strategies
-            parameter_strategies = [
-                # Record index patterns
-                ("Record Index", [i for i in range(0, 100, 10)]),
-                
-                # Time-based patterns (minutes/hours ago)
-                ("Time Offset (min)", [15*i for i in range(1, 20)]),  # Every 15 minutes for ~5 hours
-                
-                # Date-based patterns (days since reference)
-                ("Date Offset", [i for i in range(1, 8)]),  # Last 7 days
-                
-                # Record count requests
-                ("Record Count", [1, 5, 10, 20, 50, 100]),
-                
-                # Range requests (start, count)
-                ("Range Request", [(0, 10), (10, 10), (20, 10), (0, 50), (50, 50)]),
-            ]
-            
-            for strategy_name, param_values in parameter_strategies:
+            for strategy_name, param_values, fmt in PARAMETER_STRATEGIES:
                 print(f"    {strategy_name}:")
                 
                 best_responses = []
                 
                 for param in param_values:
-                    if strategy_name == "Range Request":
-                        start, count = param
-                        command = f"d155{cmd:02x}00{start:02x}{count:02x}000000000000000000"
-                        param_desc = f"{start},{count}"
-                    else:
-                        if isinstance(param, int) and param <= 0xFFFF:
-                            command = f"d155{cmd:02x}00{param:04x}00000000000000000000"
-                        else:
-                            command = f"d155{cmd:02x}00{param:08x}000000000000000000"
-                        param_desc = str(param)
+                    command = encode_command(cmd, fmt, param)
+                    param_desc = ",".join(map(str, param))
                     
                     responses = await self.send_command(command, 2.0)
                     
                     if responses:
                         # Quick analysis
-                        total_voltages = sum(len(analyze_response_for_history(r['decrypted'])['voltages']) for r in responses)
-                        total_timestamps = sum(len(analyze_response_for_history(r['decrypted'])['timestamps']) for r in responses)
+                        total_voltages, total_timestamps = total_counts(responses)
                         
                         if total_voltages > 0 or total_timestamps > 0:
-                            print(f"      {param_desc}: ✅ {len(responses)} resp, V:{total_voltages}, T:{total_timestamps}")
+                            self._log.append(f"      {param_desc}: ✅ {len(responses)} resp, V:{total_voltages}, T:{total_timestamps}")
                             best_responses.append({
                                 'param': param_desc,
                                 'command': command,
@@ -240,9 +356,11 @@ class BM6TargetedHistoryClient:
                                 'timestamps': total_timestamps
                             })
                         elif len(responses) > 1:
-                            print(f"      {param_desc}: {len(responses)} resp")
+                            self._log.append(f"      {param_desc}: {len(responses)} resp")
                     
-                    await asyncio.sleep(0.5)
+                    await self._pace()
+                
+                self._flush_log()
                 
                 # Show best responses for this strategy
                 if best_responses:
@@ -255,31 +373,28 @@ class BM6TargetedHistoryClient:
         # Test commands that might retrieve data in chunks
         bulk_commands = [
             # Different approaches to bulk data
-            ("d15506", "Bulk Data Command 1"),
-            ("d15508", "Bulk Data Command 2"), 
-            ("d15510", "Bulk Data Command 3"),
-            ("d15520", "Bulk Data Command 4"),
-            ("d15580", "High Bulk Command 1"),
-            ("d155f0", "System Bulk Command"),
-            ("d155ff", "Max Command"),
+            (0x06, "Bulk Data Command 1"),
+            (0x08, "Bulk Data Command 2"), 
+            (0x10, "Bulk Data Command 3"),
+            (0x20, "Bulk Data Command 4"),
+            (0x80, "High Bulk Command 1"),
+            (0xf0, "System Bulk Command"),
+            (0xff, "Max Command"),
         ]
         
-        for cmd_prefix, description in bulk_commands:
-            print(f"  {description}: ", end="")
-            
+        for bulk_cmd, description in bulk_commands:
             # Try with different chunk parameters
             best_result = None
             best_score = 0
             
             for chunk_size in [10, 20, 50, 100]:
                 for start_idx in [0, 1]:
-                    command = f"{cmd_prefix}{start_idx:02x}{chunk_size:02x}0000000000000000"
+                    command = encode_command(bulk_cmd, 'BB', (start_idx, chunk_size), offset=3)
                     
                     responses = await self.send_command(command, 3.0)
                     
                     if responses:
-                        total_voltages = sum(len(analyze_response_for_history(r['decrypted'])['voltages']) for r in responses)
-                        total_timestamps = sum(len(analyze_response_for_history(r['decrypted'])['timestamps']) for r in responses)
+                        total_voltages, total_timestamps = total_counts(responses)
                         
                         score = total_voltages * 2 + total_timestamps * 3 + len(responses)
                         
@@ -293,10 +408,10 @@ class BM6TargetedHistoryClient:
                             }
             
             if best_result:
-                print(f"✅ Best: {best_result['responses']} resp, V:{best_result['voltages']}, T:{best_result['timestamps']}")
-                print(f"    Command: {best_result['command']}")
+                print(f"  {description}: ✅ Best: {best_result['responses']} resp, V:{best_result['voltages']}, T:{best_result['timestamps']}")
+                print(f"    Command: {best_result['command'].hex()}")
             else:
-                print("No significant responses")
+                print(f"  {description}: No significant responses")
         
         return all_findings
     
@@ -324,12 +439,14 @@ class BM6TargetedHistoryClient:
             historical_data = []
             
             for i in range(0, 50, 5):  # Test every 5th parameter up to 50
-                command = f"d155{cmd:02x}00{i:04x}00000000000000000000"
+                command = encode_command(cmd, '>H', (i,))
                 
                 responses = await self.send_command(command, 2.0)
                 
                 for resp in responses:
-                    analysis = analyze_response_for_history(resp['decrypted'])
+                    if not any(resp['counts']):
+                        continue
+                    analysis = full_analysis(resp)
                     
                     for voltage_info in analysis['voltages']:
                         historical_data.append({
@@ -340,24 +457,21 @@ class BM6TargetedHistoryClient:
                         })
                     
                     for timestamp_info in analysis['timestamps']:
-                        print(f"   📅 Parameter {i}: Timestamp {timestamp_info['datetime'].strftime('%Y-%m-%d %H:%M:%S')}")
+                        print(f"   📅 Parameter {i}: Timestamp {datetime.fromtimestamp(timestamp_info['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
                 
-                await asyncio.sleep(0.5)
+                await self._pace()
             
             # Analyze the collected data
             if historical_data:
                 print(f"   📊 Collected {len(historical_data)} historical voltage readings:")
                 
-                # Group by voltage to see patterns
-                voltage_counts = {}
-                for data in historical_data:
-                    v = round(data['voltage'], 2)
-                    if v not in voltage_counts:
-                        voltage_counts[v] = []
-                    voltage_counts[v].append(data['parameter'])
+                # Group by voltage to see patterns (stable sort keeps parameter order)
+                def rounded_voltage(data):
+                    return round(data['voltage'], 2)
                 
-                for voltage, params in sorted(voltage_counts.items()):
-                    print(f"     {voltage}V: parameters {params}")
+                by_voltage = sorted(historical_data, key=rounded_voltage)
+                for voltage, group in groupby(by_voltage, key=rounded_voltage):
+                    print(f"     {voltage}V: parameters {[data['parameter'] for data in group]}")
                 
                 # Look for sequential patterns
                 if len(historical_data) > 5:
@@ -376,6 +490,7 @@ async def main():
     parser.add_argument('--address', type=str, required=True, help='BM6 device address')
     parser.add_argument('--output', type=str, help='Output JSON file for results')
     parser.add_argument('--quick', action='store_true', help='Quick test of most likely commands only')
+    parser.add_argument('--refresh', action='store_true', help='Always resend repeated commands instead of reusing their earlier responses')
     
     args = parser.parse_args()
     
@@ -388,7 +503,7 @@ async def main():
     else:
         print("🔍 COMPREHENSIVE MODE: Testing full command range")
     
-    client = BM6TargetedHistoryClient(args.address)
+    client = BM6TargetedHistoryClient(args.address, use_cache=not args.refresh)
     
     try:
         print(f"\n🔗 Connecting to BM6 at {args.address}...")
@@ -399,28 +514,9 @@ async def main():
             # Quick test of most likely commands
             print("\n🚀 QUICK TEST: Most Likely History Commands")
             
-            quick_commands = [
-                # Most likely based on embedded systems patterns
-                ("d1550600000000000000000000000000", "Command 06 - History List"),
-                ("d1550800000000000000000000000000", "Command 08 - History Data"),
-                ("d1551000000000000000000000000000", "Command 10 - Extended History"),
-                ("d1552000000000000000000000000000", "Command 20 - Bulk History"),
-                ("d1558000000000000000000000000000", "Command 80 - System History"),
-                
-                # Parameter variations of promising commands
-                ("d1550600010000000000000000000000", "Command 06 with param 01"),
-                ("d1550600100000000000000000000000", "Command 06 with param 10"),
-                ("d1550800010000000000000000000000", "Command 08 with param 01"),
-                ("d1550800100000000000000000000000", "Command 08 with param 10"),
-                
-                # Range-based requests
-                ("d1550600006400000000000000000000", "Command 06 - request 100 records"),
-                ("d1550800006400000000000000000000", "Command 08 - request 100 records"),
-            ]
-            
             findings = []
             
-            for command, description in quick_commands:
+            for command, description in QUICK_COMMANDS:
                 print(f"\n  {description}: ", end="")
                 
                 responses = await client.send_command(command, 3.0)
@@ -430,18 +526,20 @@ async def main():
                     total_timestamps = 0
                     
                     for resp in responses:
-                        analysis = analyze_response_for_history(resp['decrypted'])
-                        total_voltages += len(analysis['voltages'])
-                        total_timestamps += len(analysis['timestamps'])
+                        n_voltages, n_timestamps = resp['counts']
+                        total_voltages += n_voltages
+                        total_timestamps += n_timestamps
                         
                         # Show any timestamps found
-                        for ts_info in analysis['timestamps']:
-                            print(f"\n    📅 Timestamp: {ts_info['datetime'].strftime('%Y-%m-%d %H:%M:%S')}")
+                        if not n_timestamps:
+                            continue
+                        for ts_info in full_analysis(resp)['timestamps']:
+                            print(f"\n    📅 Timestamp: {datetime.fromtimestamp(ts_info['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
                     
                     if total_voltages > 0 or total_timestamps > 0:
                         print(f"✅ {len(responses)} resp, V:{total_voltages}, T:{total_timestamps}")
                         findings.append({
-                            'command': command,
+                            'command': command.hex(),
                             'description': description,
                             'responses': len(responses),
                             'voltages': total_voltages,
@@ -452,8 +550,9 @@ async def main():
                         if total_voltages > 2:
                             print(f"    Voltages found:")
                             for resp in responses:
-                                analysis = analyze_response_for_history(resp['decrypted'])
-                                for v_info in analysis['voltages']:
+                                if not resp['counts'][0]:
+                                    continue
+                                for v_info in full_analysis(resp)['voltages']:
                                     print(f"      {v_info['voltage']:.2f}V at position {v_info['position']}")
                     else:
                         print(f"{len(responses)} resp")
@@ -511,6 +610,7 @@ async def main():
         
         # Export results
         if args.output and findings:
+            import json
             with open(args.output, 'w') as f:
                 json.dump(findings, f, indent=2, default=str)
             print(f"\n💾 Results exported to {args.output}")
@@ -1,50 +1,106 @@
 import argparse
+import functools
 import json
 import sys
 import logging
+import time
 from logging.handlers import SysLogHandler
-import re
-from datetime import datetime, timezone
 
 # InfluxDB client library
 try:
-    from influxdb_client import InfluxDBClient, Point, WriteOptions
-    from influxdb_client.client.write_api import SYNCHRONOUS
+    from influxdb_client import InfluxDBClient, Point, WriteOptions, WritePrecision
     from influxdb_client.rest import ApiException
 except ImportError:
     print("Error: influxdb_client library not found. Please install it using 'pip install influxdb-client'", file=sys.stderr)
     sys.exit(1)
 
+# Prefer orjson for parsing stdin (faster, accepts bytes); fall back to the standard library
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # --- Logging Configuration ---
 # Set up a custom logger
 logger = logging.getLogger(__name__)
 # Initial level, will be adjusted by --debug flag
 logger.setLevel(logging.INFO)
 
+# Both handlers are added only once, in case the module is loaded again in-process;
+# a reload picks up the existing stderr handler so --debug can still adjust it
 # Handler for stderr
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setLevel(logging.INFO) # Initial level for stderr output
-stderr_formatter = logging.Formatter('%(levelname)s: %(message)s')
-stderr_handler.setFormatter(stderr_formatter)
-logger.addHandler(stderr_handler)
+stderr_handler = next((h for h in logger.handlers if type(h) is logging.StreamHandler), None)
+if stderr_handler is None:
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.INFO) # Initial level for stderr output
+    stderr_formatter = logging.Formatter('%(levelname)s: %(message)s')
+    stderr_handler.setFormatter(stderr_formatter)
+    logger.addHandler(stderr_handler)
 
 # Handler for syslog
-try:
-    syslog_handler = SysLogHandler(address='/dev/log', facility='user')
-    syslog_handler.setLevel(logging.DEBUG) # Only send errors to syslog
-    # syslog_formatter = logging.Formatter('json_to_influxdb: %(levelname)s: %(message)s')
-    syslog_formatter = logging.Formatter('%(filename)s[%(process)d] - [%(name)s:%(lineno)d] :: (%(funcName)s) %(levelname)s - %(message)s')
-    syslog_handler.setFormatter(syslog_formatter)
-    logger.addHandler(syslog_handler)
-except Exception as e:
-    logger.warning(f"Could not connect to syslog. Errors will only be logged to stderr. Error: {e}")
+if not any(isinstance(h, SysLogHandler) for h in logger.handlers):
+    try:
+        syslog_handler = SysLogHandler(address='/dev/log', facility='user')
+        syslog_handler.setLevel(logging.DEBUG) # Only send errors to syslog
+        # syslog_formatter = logging.Formatter('json_to_influxdb: %(levelname)s: %(message)s')
+        syslog_formatter = logging.Formatter('%(filename)s[%(process)d] - [%(name)s:%(lineno)d] :: (%(funcName)s) %(levelname)s - %(message)s')
+        syslog_handler.setFormatter(syslog_formatter)
+        logger.addHandler(syslog_handler)
+    except Exception as e:
+        logger.warning(f"Could not connect to syslog. Errors will only be logged to stderr. Error: {e}")
+
+# --- Write Batching ---
+# Points are queued and sent in batches instead of one HTTP request per line
+WRITE_OPTIONS = WriteOptions(
+    batch_size=500,
+    flush_interval=1_000,   # ms
+    jitter_interval=0,
+    retry_interval=5_000,   # ms
+    max_retries=3
+)
+
+def on_write_error(conf, data, exception):
+    """Called by the batching write API when a batch could not be written."""
+    logger.error(f"InfluxDB batch write failed: {exception}")
+    logger.error(f"Failed to write points: {data}")
+
+# --- Stdin Reading ---
+STDIN_CHUNK_SIZE = 65536
+
+def iter_lines(stream, chunk_size=STDIN_CHUNK_SIZE):
+    """Yields lines (without the newline) from a binary stream, reading in bulk chunks.
+
+    read1() returns whatever is already available, so a slow live feed is
+    still processed line by line as it arrives.
+    """
+    tail = b''
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
 
 # --- MAC Address Validation ---
-MAC_ADDRESS_PATTERN = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
+# Fixed layout "XX:XX:XX:XX:XX:XX" (":" or "-"), so check positions directly
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_MAC_SEPARATORS = frozenset(':-')
 
+@functools.lru_cache(maxsize=256) # Nearby devices repeat the same few addresses
 def is_mac_address(s):
     """Checks if a string looks like a MAC address."""
-    return bool(MAC_ADDRESS_PATTERN.match(s))
+    return (len(s) == 17
+            and _MAC_SEPARATORS.issuperset(s[2::3])
+            and _HEX_DIGITS.issuperset(s[0::3])
+            and _HEX_DIGITS.issuperset(s[1::3]))
+
+# --- Record Dispatch ---
+# Records checked by the generic dispatcher before a stable shape is bound
+SHAPE_SAMPLE_SIZE = 100
 
 # --- Main Script Logic ---
 def main():
@@ -75,6 +131,7 @@ def main():
     logger.info(f"Attempting to connect to InfluxDB at: {influxdb_url}")
 
     client = None
+    write_api = None
     try:
         # Initialize InfluxDB client
         client = InfluxDBClient(
@@ -83,7 +140,7 @@ def main():
             org=args.org,
             timeout=5000 # 5 seconds timeout for connection and operations
         )
-        write_api = client.write_api(write_options=SYNCHRONOUS)
+        write_api = client.write_api(write_options=WRITE_OPTIONS, error_callback=on_write_error)
 
         # Verify connection and authorization by attempting a health check
         try:
@@ -104,11 +161,92 @@ def main():
 
         logger.debug("InfluxDB client initialized. Now attempting to read from stdin.") ## NEW DEBUG LINES
         
-        # Read JSON from stdin line by line
+        # Bind hot names to locals once; the loop below runs for every input line
+        _loads = json_loads
+        _Point = Point
+        _debug = logger.debug
+        _warn = logger.warning
+        _write = write_api.write
+        _isinstance = isinstance
+        _time_ns = time.time_ns
+        _is_mac = is_mac_address
+        _intern = sys.intern
+        _bucket = args.bucket
+        _ns = WritePrecision.NS
+        # Checked once so debug f-strings are never built when debug is off
+        _debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+        # --- Record Processors ---
+        # Each adds fields/tags for one JSON shape to the point and returns
+        # whether at least one field was added
+        def process_dict(data, point):
+            """JSON object: all key-value pairs become fields."""
+            if _debug_enabled:
+                _debug("Parsed JSON as dictionary: %s", data)
+            has_field = False
+            for key, value in data.items():
+                # InfluxDB can handle various types directly, but ensure basic types
+                if _isinstance(value, (int, float, bool, str)):
+                    point.field(key, value)
+                    has_field = True
+                else:
+                    _warn("Skipping unsupported field type for key '%s': %s. Value: %s", key, type(value), value)
+            return has_field
+
+        def process_mac_rssi(data, point):
+            """Specific array format: [["MAC_ADDRESS", RSSI_VALUE]]. Raises on any other list shape."""
+            pair, = data
+            if type(pair) is not list:
+                raise TypeError("not a [MAC, RSSI] pair")
+            value1, value2 = pair
+            if _debug_enabled:
+                _debug("Parsed JSON as specific array format: %s", data)
+            has_field = False
+
+            # Process first value as MAC address tag
+            if _isinstance(value1, str) and _is_mac(value1):
+                value1 = _intern(value1)
+                point.tag("mac_address", value1)
+                if _debug_enabled:
+                    _debug("Added tag 'mac_address': '%s'", value1)
+            else:
+                _warn("First value in array ('%s') is not a valid MAC address or type. "
+                      "Skipping as mac_address tag.", value1)
+
+            # Process second value as RSSI field
+            if _isinstance(value2, (int, float)) and value2 < 0:
+                point.field("rssi", value2)
+                has_field = True
+                if _debug_enabled:
+                    _debug("Added field 'rssi': %s", value2)
+            else:
+                _warn("Second value in array ('%s') is not a negative number for RSSI or type. "
+                      "Skipping as rssi field.", value2)
+            return has_field
+
+        def classify(data):
+            """Generic dispatcher: returns the processor for this record's shape, or None if unsupported."""
+            if _isinstance(data, dict):
+                return process_dict
+            if _isinstance(data, list) and len(data) == 1 and \
+               _isinstance(data[0], list) and len(data[0]) == 2:
+                return process_mac_rssi
+            return None
+
+        # A stream normally carries a single JSON shape. Once SHAPE_SAMPLE_SIZE
+        # supported records in a row agree, records of that type go straight to
+        # its processor; anything that does not fit falls back to classify().
+        # Unsupported records are not sampled, so they can't block the binding.
+        sampled = 0
+        sample_shape = None # (type, processor) of the current run of supported records
+        fast_type = fast_process = None
+
+        # Read JSON from stdin line by line, as bytes so no text decoding pass is needed
         line_count = 0 ## NEW DEBUG LINES
-        for line in sys.stdin:
+        for line in iter_lines(sys.stdin.buffer):
             line_count += 1 ## NEW DEBUG LINES
-            logger.debug(f"Processing line {line_count}. Raw input: '{line.strip()}'") ## NEW DEBUG LINES
+            if _debug_enabled:
+                _debug("Processing line %d. Raw input: '%s'", line_count, line.strip().decode(errors='replace')) ## NEW DEBUG LINES
 
             line = line.strip()
             if not line:
@@ -117,70 +255,66 @@ def main():
             # logger.debug(f"Received raw JSON input: {line}") # This line is now effectively replaced by the one above
 
             try:
-                data = json.loads(line)
-            except json.JSONDecodeError as e:
+                data = _loads(line)
+            except ValueError as e: # JSONDecodeError (both parsers) or invalid UTF-8
                 logger.error(f"Malformed JSON input. Skipping this line.")
-                logger.error(f"Raw input (printed to stderr): {line}")
+                logger.error(f"Raw input (printed to stderr): {line.decode(errors='replace')}")
                 continue # Continue to the next line
 
-            # Measurement "json", current UTC time
-            point = Point("json").time(datetime.now(timezone.utc))
+            # Measurement "json", current time as integer nanoseconds (no datetime conversion)
+            point = _Point("json").time(_time_ns(), write_precision=_ns)
+
+            process = None
+            if type(data) is fast_type:
+                try:
+                    has_field = fast_process(data, point)
+                    process = fast_process
+                except (TypeError, ValueError):
+                    pass # Record does not match the sampled shape
 
-            if isinstance(data, dict):
-                logger.debug(f"Parsed JSON as dictionary: {data}")
-                # Handle JSON object: all key-value pairs become fields
-                for key, value in data.items():
-                    # InfluxDB can handle various types directly, but ensure basic types
-                    if isinstance(value, (int, float, bool, str)):
-                        point.field(key, value)
+            if process is None:
+                process = classify(data)
+                if process is not None and fast_process is None:
+                    shape = (type(data), process)
+                    if shape == sample_shape:
+                        sampled += 1
                     else:
-                        logger.warning(f"Skipping unsupported field type for key '{key}': {type(value)}. Value: {value}")
-                
-            elif isinstance(data, list) and len(data) == 1 and \
-                 isinstance(data[0], list) and len(data[0]) == 2:
-                # Handle specific array format: [["MAC_ADDRESS", RSSI_VALUE]]
-                logger.debug(f"Parsed JSON as specific array format: {data}")
-                value1, value2 = data[0][0], data[0][1]
-
-                # Process first value as MAC address tag
-                if isinstance(value1, str) and is_mac_address(value1):
-                    point.tag("mac_address", value1)
-                    logger.debug(f"Added tag 'mac_address': '{value1}'")
-                else:
-                    logger.warning(f"First value in array ('{value1}') is not a valid MAC address or type. "
-                                   f"Skipping as mac_address tag.")
-                    
-                # Process second value as RSSI field
-                if isinstance(value2, (int, float)) and value2 < 0:
-                    point.field("rssi", value2)
-                    logger.debug(f"Added field 'rssi': {value2}")
-                else:
-                    logger.warning(f"Second value in array ('{value2}') is not a negative number for RSSI or type. "
-                                   f"Skipping as rssi field.")
+                        # Start a new run from this record
+                        sample_shape = shape
+                        sampled = 1
+                    if sampled >= SHAPE_SAMPLE_SIZE:
+                        fast_type, fast_process = shape
+                        if _debug_enabled:
+                            _debug("Input shape is stable (%s); skipping generic dispatch.", fast_type.__name__)
 
-            else:
-                logger.warning(f"Unsupported JSON format: {type(data)}. Skipping this input.")
-                logger.warning(f"Raw input (printed to stderr): {line}")
-                continue # Skip unsupported formats
+                if process is None:
+                    _warn("Unsupported JSON format: %s. Skipping this input.", type(data))
+                    _warn("Raw input (printed to stderr): %s", line.decode(errors='replace'))
+                    continue # Skip unsupported formats
+                has_field = process(data, point)
 
-            # Check if any fields were added to the point, InfluxDB requires at least one field
-            if not point._fields:
-                logger.warning(f"No valid fields could be extracted from input: {line}. Skipping point.")
+            # Check if any fields were added to the point
+            if not has_field:
+                _warn("No valid fields could be extracted from input: %s. Skipping point.", line.decode(errors='replace'))
                 continue
 
             # --- Debugging Output for InfluxDB Line Protocol ---
-            line_protocol = point.to_line_protocol().strip()
-            logger.debug(f"Prepared InfluxDB Line Protocol: {line_protocol}")
+            # The write API serializes the point itself, so only do it here when debugging
+            if _debug_enabled:
+                _debug("Prepared InfluxDB Line Protocol: %s", point.to_line_protocol().strip())
 
-            # Write the point to InfluxDB
+            # Queue the point; the batching write API sends it to InfluxDB
             try:
-                write_api.write(bucket=args.bucket, record=point)
-                logger.info(f"Successfully wrote data to InfluxDB.")
+                _write(bucket=_bucket, record=point)
+                if _debug_enabled:
+                    _debug("Queued data for InfluxDB.") # Per point, so kept out of INFO
             except ApiException as e:
+                line_protocol = point.to_line_protocol().strip()
                 logger.error(f"InfluxDB API error during write operation: {e.status} - {e.reason}")
                 logger.error(f"Response Body: {e.body}")
                 logger.error(f"Failed to write point: {line_protocol}")
             except Exception as e:
+                line_protocol = point.to_line_protocol().strip()
                 logger.error(f"An unexpected error occurred during InfluxDB write: {e}")
                 logger.error(f"Failed to write point: {line_protocol}")
 
@@ -189,6 +323,9 @@ def main():
     except KeyboardInterrupt:
         logger.info("Script interrupted by user. Exiting.")
     finally:
+        if write_api:
+            # Flushes any points still waiting in the batch
+            write_api.close()
         if client:
             client.close()
             logger.info("InfluxDB client closed.")
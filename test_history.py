@@ -7,39 +7,67 @@
 import argparse
 import json
 import asyncio
-from Crypto.Cipher import AES
 from bleak import BleakClient
 from bleak import BleakScanner
-
-# BM6 encryption key (different from BM2)
-BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+from bm6_ble import write_and_wait
+from bm6_crypto import BM6_KEY, make_ecb  # BM6 key differs from BM2
 
 # BM2 encryption key for reference
 BM2_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 49, 56, 56, 50, 52, 54, 54])
 
+# Longest wait for a command's reply, and how long to keep listening for
+# trailing packets once it has been answered
+RESPONSE_TIMEOUT = 2.0
+RESPONSE_QUIET_PERIOD = 0.2
+
+_bm6_encrypt, _bm6_decrypt = make_ecb(BM6_KEY)
+_bm2_encrypt, _bm2_decrypt = make_ecb(BM2_KEY)
+
 def decrypt_bm6(crypted):
     """Decrypt data using BM6 key"""
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    decrypted = cipher.decrypt(crypted).hex()
-    return decrypted
+    return _bm6_decrypt(crypted)
 
 def encrypt_bm6(plaintext):
     """Encrypt data using BM6 key"""
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    encrypted = cipher.encrypt(plaintext)
-    return encrypted
+    return _bm6_encrypt(plaintext)
 
 def decrypt_bm2(crypted):
     """Decrypt data using BM2 key for comparison"""
-    cipher = AES.new(BM2_KEY, AES.MODE_CBC, 16 * b'\0')
-    decrypted = cipher.decrypt(crypted).hex()
-    return decrypted
+    return _bm2_decrypt(crypted)
 
 def encrypt_bm2(plaintext):
     """Encrypt data using BM2 key for comparison"""
-    cipher = AES.new(BM2_KEY, AES.MODE_CBC, 16 * b'\0')
-    encrypted = cipher.encrypt(plaintext)
-    return encrypted
+    return _bm2_encrypt(plaintext)
+
+# Test commands to try (based on BM2 reverse engineering patterns), parsed once
+TEST_COMMANDS = [(bytes.fromhex(command_hex), description) for command_hex, description in [
+    # Standard voltage command (known to work)
+    ("d1550700000000000000000000000000", "Standard voltage command (baseline)"),
+    
+    # Potential history commands based on BM2 patterns
+    ("f5508164000000000000000000000000", "BM2-style history command 1"),
+    ("f5507164000000000000000000000000", "BM2-style history command 2"), 
+    ("f5500164000000000000000000000000", "BM2-style history command 3"),
+    ("d1558164000000000000000000000000", "BM6-style history command 1"),
+    ("d1557164000000000000000000000000", "BM6-style history command 2"),
+    ("d1550164000000000000000000000000", "BM6-style history command 3"),
+    
+    # Try different command prefixes
+    ("d2550700000000000000000000000000", "Alternative prefix d2"),
+    ("d3550700000000000000000000000000", "Alternative prefix d3"),
+    ("d1560700000000000000000000000000", "Alternative command d156"),
+    ("d1570700000000000000000000000000", "Alternative command d157"),
+    
+    # Try history-specific patterns
+    ("d1550800000000000000000000000000", "History variant 1"),
+    ("d1550900000000000000000000000000", "History variant 2"),
+    ("d1550a00000000000000000000000000", "History variant 3"),
+    ("d1550b00000000000000000000000000", "History variant 4"),
+]]
+
+# The commands are constants, so encrypt them once up front
+ENCRYPTED_TEST_COMMANDS = [(encrypt_bm6(command_bytes), command_bytes, description)
+                           for command_bytes, description in TEST_COMMANDS]
 
 async def scan_bm6():
     """Scan for BM6 devices"""
@@ -60,63 +88,38 @@ async def scan_bm6():
     return device_list
 
 async def test_history_commands(address):
-    """Test various history-related commands on BM6"""
+    """Test various history-related commands on BM6
     
-    # Test commands to try (based on BM2 reverse engineering patterns)
-    test_commands = [
-        # Standard voltage command (known to work)
-        ("d1550700000000000000000000000000", "Standard voltage command (baseline)"),
-        
-        # Potential history commands based on BM2 patterns
-        ("f5508164000000000000000000000000", "BM2-style history command 1"),
-        ("f5507164000000000000000000000000", "BM2-style history command 2"), 
-        ("f5500164000000000000000000000000", "BM2-style history command 3"),
-        ("d1558164000000000000000000000000", "BM6-style history command 1"),
-        ("d1557164000000000000000000000000", "BM6-style history command 2"),
-        ("d1550164000000000000000000000000", "BM6-style history command 3"),
-        
-        # Try different command prefixes
-        ("d2550700000000000000000000000000", "Alternative prefix d2"),
-        ("d3550700000000000000000000000000", "Alternative prefix d3"),
-        ("d1560700000000000000000000000000", "Alternative command d156"),
-        ("d1570700000000000000000000000000", "Alternative command d157"),
-        
-        # Try history-specific patterns
-        ("d1550800000000000000000000000000", "History variant 1"),
-        ("d1550900000000000000000000000000", "History variant 2"),
-        ("d1550a00000000000000000000000000", "History variant 3"),
-        ("d1550b00000000000000000000000000", "History variant 4"),
-    ]
+    Each command waits for its own reply before the next is written, and moves
+    on once RESPONSE_QUIET_PERIOD passes without another packet instead of
+    always sleeping RESPONSE_TIMEOUT.
+    """
     
     results = []
+    response_event = asyncio.Event()
     
     async def notification_handler(sender, data):
         """Handle notifications from the device"""
         try:
             decrypted = decrypt_bm6(data)
-            timestamp = asyncio.get_event_loop().time()
+            timestamp = asyncio.get_running_loop().time()
             
             # Also try BM2 decryption for comparison
             try:
                 bm2_decrypted = decrypt_bm2(data)
-                results.append({
-                    'timestamp': timestamp,
-                    'raw_data': data.hex(),
-                    'bm6_decrypted': decrypted,
-                    'bm2_decrypted': bm2_decrypted,
-                    'data_length': len(data)
-                })
             except:
-                results.append({
-                    'timestamp': timestamp,
-                    'raw_data': data.hex(),
-                    'bm6_decrypted': decrypted,
-                    'bm2_decrypted': 'failed',
-                    'data_length': len(data)
-                })
+                bm2_decrypted = 'failed'
+            results.append({
+                'timestamp': timestamp,
+                'raw_data': bytes(data),
+                'bm6_decrypted': decrypted,
+                'bm2_decrypted': bm2_decrypted,
+                'data_length': len(data)
+            })
+            response_event.set()
                 
             print(f"  Received: {data.hex()}")
-            print(f"  BM6 decrypt: {decrypted}")
+            print(f"  BM6 decrypt: {decrypted.hex()}")
             
         except Exception as e:
             print(f"  Error decrypting: {e}")
@@ -128,46 +131,37 @@ async def test_history_commands(address):
         await client.start_notify("FFF4", notification_handler)
         print("Subscribed to notifications on FFF4")
         
-        for command_hex, description in test_commands:
+        for encrypted_command, command_bytes, description in ENCRYPTED_TEST_COMMANDS:
             print(f"\nTesting: {description}")
-            print(f"Command: {command_hex}")
+            print(f"Command: {command_bytes.hex()}")
             
             try:
                 # Clear previous results
                 results.clear()
                 
-                # Send the encrypted command
-                command_bytes = bytearray.fromhex(command_hex)
-                encrypted_command = encrypt_bm6(command_bytes)
-                
                 print(f"Encrypted: {encrypted_command.hex()}")
-                await client.write_gatt_char("FFF3", encrypted_command, response=True)
-                
-                # Wait for responses
-                await asyncio.sleep(2)
+                await write_and_wait(client, encrypted_command, response_event,
+                                     RESPONSE_TIMEOUT, RESPONSE_QUIET_PERIOD)
                 
                 if results:
                     print(f"Results ({len(results)} responses):")
                     for i, result in enumerate(results):
                         print(f"  Response {i+1}:")
-                        print(f"    Raw: {result['raw_data']}")
-                        print(f"    BM6: {result['bm6_decrypted']}")
+                        print(f"    Raw: {result['raw_data'].hex()}")
+                        print(f"    BM6: {result['bm6_decrypted'].hex()}")
                         if result['bm2_decrypted'] != 'failed':
-                            print(f"    BM2: {result['bm2_decrypted']}")
+                            print(f"    BM2: {result['bm2_decrypted'].hex()}")
                         
                         # Try to parse as voltage/temp data
                         decrypted = result['bm6_decrypted']
-                        if len(decrypted) >= 18 and decrypted.startswith('d15507'):
-                            try:
-                                voltage = int(decrypted[15:18], 16) / 100
-                                temp_flag = decrypted[6:8]
-                                if temp_flag == "01":
-                                    temperature = -int(decrypted[8:10], 16)
-                                else:
-                                    temperature = int(decrypted[8:10], 16)
-                                print(f"    Parsed: {voltage}V, {temperature}°C")
-                            except:
-                                print(f"    Parse failed")
+                        if len(decrypted) >= 9 and decrypted.startswith(b'\xd1\x55\x07'):
+                            # 12 bits: low nibble of byte 7 and byte 8 (hex digits 15-17)
+                            voltage = (((decrypted[7] & 0x0f) << 8) | decrypted[8]) / 100
+                            if decrypted[3] == 0x01:
+                                temperature = -decrypted[4]
+                            else:
+                                temperature = decrypted[4]
+                            print(f"    Parsed: {voltage}V, {temperature}°C")
                 else:
                     print("  No responses received")
                     
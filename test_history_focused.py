@@ -7,135 +7,136 @@
 import argparse
 import json
 import asyncio
-import time
-from Crypto.Cipher import AES
+import struct
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
 from bleak import BleakClient
 from bleak import BleakScanner
+from bm6_crypto import decrypt_bm6, encrypt_bm6
+from bm6_ble import wait_for_responses
 
-# BM6 encryption key
-BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+# Response timing: longest wait per command, and the silence after the
+# last response that ends the wait early
+RESPONSE_TIMEOUT = 5.0
+RESPONSE_QUIET_PERIOD = 0.5
 
-def decrypt_bm6(crypted):
-    """Decrypt data using BM6 key"""
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    decrypted = cipher.decrypt(crypted).hex()
-    return decrypted
+# d15507 frame fields after the 3-byte header, decoded in one C-level call:
+# temperature sign flag, temperature, (skip), SoC, voltage * 100 (big-endian;
+# only the low 12 bits, hex digits 15-17, hold the voltage)
+_VOLTAGE_FRAME = struct.Struct('>3xBBxBH')
 
-def encrypt_bm6(plaintext):
-    """Encrypt data using BM6 key"""
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    encrypted = cipher.encrypt(plaintext)
-    return encrypted
+@dataclass(slots=True)
+class Analysis:
+    """Classification of one decrypted response; unknown responses only carry raw"""
+    raw: bytes
+    is_standard_voltage: bool = False
+    is_potential_history: bool = False
+    parsed_data: Optional[Dict[str, Any]] = None
 
-def analyze_response(decrypted_hex):
-    """Analyze decrypted response for patterns"""
-    analysis = {
-        'is_standard_voltage': False,
-        'is_potential_history': False,
-        'prefix': decrypted_hex[:6] if len(decrypted_hex) >= 6 else '',
-        'full_data': decrypted_hex,
-        'parsed_data': {}
-    }
-    
+def analyze_response(raw):
+    """Analyze decrypted response bytes for patterns
+
+    The hex form is only needed for display, so callers take raw.hex() on demand.
+    """
     # Check if it's standard voltage data
-    if decrypted_hex.startswith('d15507') and len(decrypted_hex) >= 18:
-        analysis['is_standard_voltage'] = True
-        try:
-            voltage = int(decrypted_hex[15:18], 16) / 100
-            temp_flag = decrypted_hex[6:8]
-            if temp_flag == "01":
-                temperature = -int(decrypted_hex[8:10], 16)
-            else:
-                temperature = int(decrypted_hex[8:10], 16)
-            analysis['parsed_data'] = {
-                'voltage': voltage,
-                'temperature': temperature,
-                'soc': int(decrypted_hex[12:14], 16) if len(decrypted_hex) >= 14 else None
-            }
-        except:
-            pass
+    if raw.startswith(b'\xd1\x55\x07') and len(raw) >= 9:
+        temp_flag, temperature, soc, voltage = _VOLTAGE_FRAME.unpack_from(raw)
+        if temp_flag == 0x01:
+            temperature = -temperature
+        return Analysis(raw, is_standard_voltage=True, parsed_data={
+            'voltage': (voltage & 0x0fff) / 100,
+            'temperature': temperature,
+            'soc': soc
+        })
     
     # Check for potential history data patterns
-    elif decrypted_hex.startswith('d155') and not decrypted_hex.startswith('d15507'):
-        analysis['is_potential_history'] = True
+    if raw.startswith(b'\xd1\x55') and raw[2:3] != b'\x07':
         # Try to parse command structure
-        if len(decrypted_hex) >= 8:
-            analysis['parsed_data'] = {
-                'command_type': decrypted_hex[4:6],
-                'sub_command': decrypted_hex[6:8],
-                'data_section': decrypted_hex[8:] if len(decrypted_hex) > 8 else ''
+        parsed_data = None
+        if len(raw) >= 4:
+            parsed_data = {
+                'command_type': f"{raw[2]:02x}",
+                'sub_command': f"{raw[3]:02x}",
+                'data_section': raw[4:].hex()
             }
+        return Analysis(raw, is_potential_history=True, parsed_data=parsed_data)
+    
+    return Analysis(raw)
+
+# Commands that showed promise, plus variations
+FOCUSED_COMMANDS = [
+    # The three commands that gave interesting results
+    ("d1550164000000000000000000000000", "Promising command 1 (gave unique response)"),
+    ("d1550900000000000000000000000000", "Promising command 2 (echo response)"),
+    ("d1550a00000000000000000000000000", "Promising command 3 (modified response)"),
+    
+    # Variations of the promising commands with different parameters
+    ("d1550164010000000000000000000000", "Command 1 with param 01"),
+    ("d1550164020000000000000000000000", "Command 1 with param 02"),
+    ("d1550164ff0000000000000000000000", "Command 1 with param ff"),
+    
+    ("d1550900010000000000000000000000", "Command 2 with param 01"),
+    ("d1550900020000000000000000000000", "Command 2 with param 02"),
+    ("d1550900ff0000000000000000000000", "Command 2 with param ff"),
+    
+    ("d1550a00010000000000000000000000", "Command 3 with param 01"),
+    ("d1550a00020000000000000000000000", "Command 3 with param 02"),
+    ("d1550a00ff0000000000000000000000", "Command 3 with param ff"),
+    
+    # Try sequential commands that might be history-related
+    ("d1550c00000000000000000000000000", "Next in sequence (0c)"),
+    ("d1550d00000000000000000000000000", "Next in sequence (0d)"),
+    ("d1550e00000000000000000000000000", "Next in sequence (0e)"),
+    ("d1550f00000000000000000000000000", "Next in sequence (0f)"),
     
-    return analysis
+    # Try different command types with the 01 pattern
+    ("d1550101000000000000000000000000", "Command type 01 variant 1"),
+    ("d1550102000000000000000000000000", "Command type 01 variant 2"),
+    ("d1550103000000000000000000000000", "Command type 01 variant 3"),
+    
+    # Test if it's a read/write pattern
+    ("d1550264000000000000000000000000", "Read variant of command 1"),
+    ("d1550364000000000000000000000000", "Write variant of command 1"),
+]
+
+# The commands are constants, so encrypt them once at import
+ENCRYPTED_FOCUSED_COMMANDS = [(encrypt_bm6(bytes.fromhex(command_hex)), command_hex, description)
+                              for command_hex, description in FOCUSED_COMMANDS]
 
 async def test_focused_history_commands(address):
     """Test the most promising commands with variations and longer waits"""
     
-    # Commands that showed promise, plus variations
-    focused_commands = [
-        # The three commands that gave interesting results
-        ("d1550164000000000000000000000000", "Promising command 1 (gave unique response)"),
-        ("d1550900000000000000000000000000", "Promising command 2 (echo response)"),
-        ("d1550a00000000000000000000000000", "Promising command 3 (modified response)"),
-        
-        # Variations of the promising commands with different parameters
-        ("d1550164010000000000000000000000", "Command 1 with param 01"),
-        ("d1550164020000000000000000000000", "Command 1 with param 02"),
-        ("d1550164ff0000000000000000000000", "Command 1 with param ff"),
-        
-        ("d1550900010000000000000000000000", "Command 2 with param 01"),
-        ("d1550900020000000000000000000000", "Command 2 with param 02"),
-        ("d1550900ff0000000000000000000000", "Command 2 with param ff"),
-        
-        ("d1550a00010000000000000000000000", "Command 3 with param 01"),
-        ("d1550a00020000000000000000000000", "Command 3 with param 02"),
-        ("d1550a00ff0000000000000000000000", "Command 3 with param ff"),
-        
-        # Try sequential commands that might be history-related
-        ("d1550c00000000000000000000000000", "Next in sequence (0c)"),
-        ("d1550d00000000000000000000000000", "Next in sequence (0d)"),
-        ("d1550e00000000000000000000000000", "Next in sequence (0e)"),
-        ("d1550f00000000000000000000000000", "Next in sequence (0f)"),
-        
-        # Try different command types with the 01 pattern
-        ("d1550101000000000000000000000000", "Command type 01 variant 1"),
-        ("d1550102000000000000000000000000", "Command type 01 variant 2"),
-        ("d1550103000000000000000000000000", "Command type 01 variant 3"),
-        
-        # Test if it's a read/write pattern
-        ("d1550264000000000000000000000000", "Read variant of command 1"),
-        ("d1550364000000000000000000000000", "Write variant of command 1"),
-    ]
-    
-    all_responses = []
+    # Analyses of the unique responses to the current command, in arrival
+    # order; both are rebound per command so earlier results can be freed.
+    # Retransmitted notifications are dropped by raw bytes before any decrypt.
+    seen = set()
+    current_responses = []
+    response_event = asyncio.Event()
     
     async def notification_handler(sender, data):
         """Enhanced notification handler"""
         try:
-            timestamp = time.time()
-            decrypted = decrypt_bm6(data)
-            analysis = analyze_response(decrypted)
+            key = bytes(data)
+            if key in seen:
+                return
+            seen.add(key)
             
-            response_data = {
-                'timestamp': timestamp,
-                'raw_data': data.hex(),
-                'decrypted': decrypted,
-                'analysis': analysis
-            }
-            all_responses.append(response_data)
+            analysis = analyze_response(decrypt_bm6(key))
+            current_responses.append(analysis)
+            response_event.set()
             
             # Print immediate feedback
-            if analysis['is_potential_history']:
-                print(f"  🎯 POTENTIAL HISTORY DATA: {decrypted}")
-                if analysis['parsed_data']:
-                    print(f"     Command type: {analysis['parsed_data'].get('command_type', 'unknown')}")
-                    print(f"     Sub-command: {analysis['parsed_data'].get('sub_command', 'unknown')}")
-                    print(f"     Data: {analysis['parsed_data'].get('data_section', 'none')}")
-            elif analysis['is_standard_voltage']:
-                parsed = analysis['parsed_data']
+            if analysis.is_potential_history:
+                print(f"  🎯 POTENTIAL HISTORY DATA: {analysis.raw.hex()}")
+                if analysis.parsed_data:
+                    print(f"     Command type: {analysis.parsed_data.get('command_type', 'unknown')}")
+                    print(f"     Sub-command: {analysis.parsed_data.get('sub_command', 'unknown')}")
+                    print(f"     Data: {analysis.parsed_data.get('data_section', 'none')}")
+            elif analysis.is_standard_voltage:
+                parsed = analysis.parsed_data
                 print(f"  📊 Standard: {parsed['voltage']}V, {parsed['temperature']}°C")
             else:
-                print(f"  ❓ Unknown: {decrypted}")
+                print(f"  ❓ Unknown: {analysis.raw.hex()}")
                 
         except Exception as e:
             print(f"  ❌ Error: {e}")
@@ -145,39 +146,33 @@ async def test_focused_history_commands(address):
         await client.start_notify("FFF4", notification_handler)
         print("👂 Listening for responses...\n")
         
-        for i, (command_hex, description) in enumerate(focused_commands):
-            print(f"[{i+1}/{len(focused_commands)}] Testing: {description}")
+        for i, (encrypted_command, command_hex, description) in enumerate(ENCRYPTED_FOCUSED_COMMANDS):
+            print(f"[{i+1}/{len(ENCRYPTED_FOCUSED_COMMANDS)}] Testing: {description}")
             print(f"Command: {command_hex}")
             
             try:
-                # Clear previous responses for this command
-                all_responses.clear()
+                # Fresh response collection for this command
+                seen = set()
+                current_responses = []
+                response_event.clear()
                 
                 # Send command
-                command_bytes = bytearray.fromhex(command_hex)
-                encrypted_command = encrypt_bm6(command_bytes)
                 await client.write_gatt_char("FFF3", encrypted_command, response=True)
                 
                 # Wait longer for potential multiple history responses
-                await asyncio.sleep(5)  # Increased wait time
+                await wait_for_responses(response_event, RESPONSE_TIMEOUT, RESPONSE_QUIET_PERIOD)
                 
                 # Analyze responses for this command
-                unique_responses = {}
-                for response in all_responses:
-                    key = response['decrypted']
-                    if key not in unique_responses:
-                        unique_responses[key] = response
-                
-                print(f"📋 Results: {len(unique_responses)} unique responses")
+                print(f"📋 Results: {len(current_responses)} unique responses")
                 
                 history_responses = []
                 voltage_responses = []
                 unknown_responses = []
                 
-                for response in unique_responses.values():
-                    if response['analysis']['is_potential_history']:
+                for response in current_responses:
+                    if response.is_potential_history:
                         history_responses.append(response)
-                    elif response['analysis']['is_standard_voltage']:
+                    elif response.is_standard_voltage:
                         voltage_responses.append(response)
                     else:
                         unknown_responses.append(response)
@@ -185,15 +180,15 @@ async def test_focused_history_commands(address):
                 if history_responses:
                     print(f"🎯 HISTORY CANDIDATES ({len(history_responses)}):")
                     for resp in history_responses:
-                        print(f"   {resp['decrypted']}")
-                        if resp['analysis']['parsed_data']:
-                            parsed = resp['analysis']['parsed_data']
+                        print(f"   {resp.raw.hex()}")
+                        if resp.parsed_data:
+                            parsed = resp.parsed_data
                             print(f"      Type: {parsed.get('command_type')}, Sub: {parsed.get('sub_command')}")
                 
                 if unknown_responses:
                     print(f"❓ UNKNOWN RESPONSES ({len(unknown_responses)}):")
                     for resp in unknown_responses:
-                        print(f"   {resp['decrypted']}")
+                        print(f"   {resp.raw.hex()}")
                         
                 print()
                 
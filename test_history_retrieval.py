@@ -6,71 +6,154 @@
 
 import argparse
 import asyncio
+import functools
 import time
 import struct
 from datetime import datetime, timedelta
-from Crypto.Cipher import AES
 from bleak import BleakClient
+from bm6_crypto import decrypt_bm6, encrypt_bm6
+from bm6_ble import wait_for_responses
 
-# BM6 encryption key
-BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+# Response timing per command: longest wait, and the silence after the last
+# 0A response that ends the wait early. Multi-record requests get longer.
+RESPONSE_TIMEOUT = 1.0
+RESPONSE_QUIET_PERIOD = 0.1
+MULTI_RECORD_TIMEOUT = 2.0
+MULTI_RECORD_QUIET_PERIOD = 0.2
 
-def decrypt_bm6(crypted):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.decrypt(crypted).hex()
-
-def encrypt_bm6(plaintext):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.encrypt(plaintext)
-
-def analyze_0a_response(response_hex):
-    """Analyze 0A command responses for patterns"""
-    if not response_hex.startswith('d1550a00'):
+def analyze_0a_response(raw):
+    """Analyze 0A command responses (decrypted bytes) for patterns"""
+    if not raw.startswith(b'\xd1\x55\x0a\x00'):
         return None
     
-    # Extract the data portion after d1550a00
-    data_part = response_hex[8:]  # Skip 'd1550a00'
-    
+    # Up to 8 data bytes as individual values, in one bytes -> list conversion
+    potential_values = list(raw[4:12])
     analysis = {
-        'full_response': response_hex,
-        'data_section': data_part,
-        'potential_values': []
+        'full_response': raw.hex(),
+        # Data portion after d1550a00
+        'data_section': raw[4:].hex(),
+        'potential_values': potential_values,
+        # What every phase reports; built once per packet rather than per phase
+        'non_zero_values': [v for v in potential_values if v]
     }
     
-    # Try to extract meaningful values from the data section
-    try:
-        # Parse as pairs of bytes
-        for i in range(0, min(len(data_part), 16), 2):
-            if i + 2 <= len(data_part):
-                byte_val = int(data_part[i:i+2], 16)
-                analysis['potential_values'].append(byte_val)
-    except:
-        pass
-    
     return analysis
 
+@functools.lru_cache(maxsize=16) # Retransmitted notifications repeat the last few packets
+def analyze_packet(raw):
+    """Decrypt and analyze one notification; repeated packets skip both steps"""
+    return analyze_0a_response(decrypt_bm6(raw))
+
+# --- Command Tables ---
+# Every command is encrypted before connecting, so the BLE session only writes.
+# Commands are the 0A header followed by parameter bytes, zero-padded to 16 bytes.
+COMMAND_PREFIX = b'\xd1\x55\x0a\x00'
+
+# 16-bit parameter packers, compiled once
+_PACK_LE = struct.Struct('<H').pack
+_PACK_BE = struct.Struct('>H').pack
+
+# Phase 1: single-byte parameter 0-50 (history record indices or counts?)
+PHASE1_COMMANDS = [(param, encrypt_bm6(COMMAND_PREFIX + bytes((param,)) + bytes(11)))
+                   for param in range(0, 51)]
+
+# Phase 2: 16-bit values that might represent record counts or timestamps,
+# each tried little-endian and big-endian
+PHASE2_TEST_VALUES = [
+    0x0001, 0x0002, 0x0005, 0x000A, 0x0010, 0x0020, 0x0030,
+    0x0064, 0x00FF, 0x0100, 0x0200, 0x03E8, 0x07D0, 0x1000,
+    0x2000, 0x4000, 0x8000, 0xFFFF
+]
+PHASE2_COMMANDS = [(value, endian, encrypt_bm6(COMMAND_PREFIX + pack(value) + bytes(10)))
+                   for value in PHASE2_TEST_VALUES
+                   for endian, pack in (('little', _PACK_LE), ('big', _PACK_BE))]
+
+# Phase 4: combinations that might request multiple records
+MULTI_TESTS = [
+    ("010100", "Start=1, Count=1"),
+    ("010500", "Start=1, Count=5"), 
+    ("000A00", "Start=0, Count=10"),
+    ("001E00", "Start=0, Count=30"),
+    ("000001", "Different pattern 1"),
+    ("000002", "Different pattern 2"),
+    ("010203", "Sequential bytes"),
+    ("FF0001", "High start, count 1"),
+]
+PHASE4_COMMANDS = [(description, encrypt_bm6(COMMAND_PREFIX + bytes.fromhex(params) + bytes(9)))
+                   for params, description in MULTI_TESTS]
+
+def build_phase3_commands(now):
+    """Encrypted timestamp-like commands relative to now: (hours_ago, value, encrypted)
+
+    Formats often collide (e.g. timestamp & 0xFF vs hours_ago), so each value
+    is only sent once, under the first hours_ago that produced it.
+    """
+    commands = []
+    seen_values = set()
+    for hours_ago in [1, 6, 12, 24, 48, 72, 168]:  # 1h to 1 week ago
+        timestamp = now - (hours_ago * 3600)
+        
+        # Try different timestamp formats
+        test_formats = [
+            timestamp & 0xFFFF,           # Lower 16 bits
+            (timestamp >> 16) & 0xFFFF,   # Upper 16 bits  
+            timestamp & 0xFF,             # Single byte
+            hours_ago,                    # Hours directly
+        ]
+        
+        for fmt_value in test_formats:
+            if fmt_value > 0xFFFF or fmt_value in seen_values:
+                continue
+            seen_values.add(fmt_value)
+            command = COMMAND_PREFIX + _PACK_BE(fmt_value) + bytes(10)
+            commands.append((hours_ago, fmt_value, encrypt_bm6(command)))
+    return commands
+
+async def run_sweep(client, commands, history_responses, event):
+    """Send (*label, encrypted) commands one at a time, each waited out in turn
+
+    Every command's replies (including trailing packets) are collected before
+    the next write, so a retransmit or a missing reply can't shift later
+    results. Yields (label, analysis of the first 0A reply or None, error).
+    """
+    for *label, encrypted in commands:
+        history_responses.clear()
+        event.clear()
+        try:
+            await client.write_gatt_char("FFF3", encrypted, response=True)
+            await wait_for_responses(event, RESPONSE_TIMEOUT, RESPONSE_QUIET_PERIOD)
+        except Exception as e:
+            yield label, None, e
+            continue
+        yield label, history_responses[0]['analysis'] if history_responses else None, None
+
 async def test_history_retrieval(address):
     """Systematically test the 0A command with various parameters"""
     
     history_responses = []
+    response_event = asyncio.Event()
     
     async def notification_handler(sender, data):
         timestamp = time.time()
-        decrypted = decrypt_bm6(data)
+        analysis = analyze_packet(bytes(data))
         
-        if decrypted.startswith('d1550a00'):
-            analysis = analyze_0a_response(decrypted)
+        if analysis is not None:
+            decrypted = analysis['full_response']
             history_responses.append({
                 'timestamp': timestamp,
                 'raw': data.hex(),
                 'decrypted': decrypted,
                 'analysis': analysis
             })
+            response_event.set()
             
             print(f"  📦 Response: {decrypted}")
             if analysis and analysis['potential_values']:
                 print(f"     Values: {analysis['potential_values']}")
 
+    # Test recent timestamps (days/hours ago)
+    phase3_commands = build_phase3_commands(int(time.time()))
+
     async with BleakClient(address, timeout=30) as client:
         print(f"🔗 Connected to BM6 at {address}")
         await client.start_notify("FFF4", notification_handler)
@@ -78,168 +161,87 @@ async def test_history_retrieval(address):
         print("\n🧪 PHASE 1: Test parameter range 0-50")
         print("Looking for history record indices or counts...")
         
-        for param in range(0, 51):
-            history_responses.clear()
-            
-            # Build command: d1550a00 + param + zeros
-            command = f"d1550a00{param:02x}0000000000000000000000"
+        async for (param,), analysis, error in run_sweep(client, PHASE1_COMMANDS, history_responses, response_event):
             print(f"Testing param {param:02x}: ", end="")
             
-            try:
-                command_bytes = bytearray.fromhex(command)
-                encrypted = encrypt_bm6(command_bytes)
-                await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(1)
-                
-                if history_responses:
-                    resp = history_responses[0]
-                    analysis = resp['analysis']
-                    if analysis and analysis['potential_values']:
-                        non_zero_values = [v for v in analysis['potential_values'] if v != 0]
-                        if non_zero_values:
-                            print(f"Got values: {non_zero_values}")
-                        else:
-                            print("All zeros")
+            if error is not None:
+                print(f"Error: {error}")
+            elif analysis is not None:
+                if analysis['potential_values']:
+                    non_zero_values = analysis['non_zero_values']
+                    if non_zero_values:
+                        print(f"Got values: {non_zero_values}")
                     else:
-                        print("No data")
+                        print("All zeros")
                 else:
-                    print("No response")
-                    
-            except Exception as e:
-                print(f"Error: {e}")
+                    print("No data")
+            else:
+                print("No response")
         
         print("\n🧪 PHASE 2: Test 16-bit parameters")
         print("Testing larger parameter values...")
         
-        # Test some 16-bit values that might represent record counts or timestamps
-        test_values = [
-            0x0001, 0x0002, 0x0005, 0x000A, 0x0010, 0x0020, 0x0030,
-            0x0064, 0x00FF, 0x0100, 0x0200, 0x03E8, 0x07D0, 0x1000,
-            0x2000, 0x4000, 0x8000, 0xFFFF
-        ]
-        
-        for value in test_values:
-            history_responses.clear()
+        async for (value, endian), analysis, error in run_sweep(client, PHASE2_COMMANDS, history_responses, response_event):
+            print(f"Testing 0x{value:04x} ({endian}): ", end="")
             
-            # Try both little-endian and big-endian
-            for endian in ['little', 'big']:
-                if endian == 'little':
-                    param_bytes = struct.pack('<H', value).hex()
-                else:
-                    param_bytes = struct.pack('>H', value).hex()
-                
-                command = f"d1550a00{param_bytes}00000000000000000000"
-                print(f"Testing 0x{value:04x} ({endian}): ", end="")
-                
-                try:
-                    command_bytes = bytearray.fromhex(command)
-                    encrypted = encrypt_bm6(command_bytes)
-                    await client.write_gatt_char("FFF3", encrypted, response=True)
-                    await asyncio.sleep(1)
-                    
-                    if history_responses:
-                        resp = history_responses[0]
-                        analysis = resp['analysis']
-                        if analysis and analysis['potential_values']:
-                            non_zero_values = [v for v in analysis['potential_values'] if v != 0]
-                            if non_zero_values:
-                                print(f"Values: {non_zero_values}")
-                            else:
-                                print("Zeros")
-                        else:
-                            print("No data")
+            if error is not None:
+                print(f"Error: {error}")
+            elif analysis is not None:
+                if analysis['potential_values']:
+                    non_zero_values = analysis['non_zero_values']
+                    if non_zero_values:
+                        print(f"Values: {non_zero_values}")
                     else:
-                        print("No response")
-                        
-                except Exception as e:
-                    print(f"Error: {e}")
+                        print("Zeros")
+                else:
+                    print("No data")
+            else:
+                print("No response")
         
         print("\n🧪 PHASE 3: Test timestamp-like parameters")
         print("Testing values that might represent time...")
         
-        # Test recent timestamps (days/hours ago)
-        now = int(time.time())
-        for hours_ago in [1, 6, 12, 24, 48, 72, 168]:  # 1h to 1 week ago
-            timestamp = now - (hours_ago * 3600)
+        async for (hours_ago, fmt_value), analysis, error in run_sweep(client, phase3_commands, history_responses, response_event):
+            print(f"Testing {hours_ago}h ago (0x{fmt_value:04x}): ", end="")
             
-            # Try different timestamp formats
-            test_formats = [
-                timestamp & 0xFFFF,           # Lower 16 bits
-                (timestamp >> 16) & 0xFFFF,   # Upper 16 bits  
-                timestamp & 0xFF,             # Single byte
-                hours_ago,                    # Hours directly
-            ]
-            
-            for fmt_value in test_formats:
-                if fmt_value > 0xFFFF:
-                    continue
-                    
-                history_responses.clear()
-                param_bytes = struct.pack('>H', fmt_value).hex()
-                command = f"d1550a00{param_bytes}00000000000000000000"
-                
-                print(f"Testing {hours_ago}h ago (0x{fmt_value:04x}): ", end="")
-                
-                try:
-                    command_bytes = bytearray.fromhex(command)
-                    encrypted = encrypt_bm6(command_bytes)
-                    await client.write_gatt_char("FFF3", encrypted, response=True)
-                    await asyncio.sleep(1)
-                    
-                    if history_responses:
-                        resp = history_responses[0]
-                        analysis = resp['analysis']
-                        if analysis and analysis['potential_values']:
-                            non_zero_values = [v for v in analysis['potential_values'] if v != 0]
-                            if non_zero_values:
-                                print(f"Values: {non_zero_values}")
-                                # Check if this looks like voltage data
-                                for val in non_zero_values:
-                                    if 600 <= val <= 2000:  # Voltage range 6-20V * 100
-                                        voltage = val / 100.0
-                                        print(f"       -> Potential voltage: {voltage}V")
-                            else:
-                                print("Zeros")
-                        else:
-                            print("No data")
+            if error is not None:
+                print(f"Error: {error}")
+            elif analysis is not None:
+                if analysis['potential_values']:
+                    non_zero_values = analysis['non_zero_values']
+                    if non_zero_values:
+                        print(f"Values: {non_zero_values}")
+                        # Check if this looks like voltage data
+                        for val in non_zero_values:
+                            if 600 <= val <= 2000:  # Voltage range 6-20V * 100
+                                voltage = val / 100.0
+                                print(f"       -> Potential voltage: {voltage}V")
                     else:
-                        print("No response")
-                        
-                except Exception as e:
-                    print(f"Error: {e}")
+                        print("Zeros")
+                else:
+                    print("No data")
+            else:
+                print("No response")
         
         print("\n🧪 PHASE 4: Test multi-parameter commands")
         print("Testing commands with multiple parameters...")
         
-        # Try combinations that might request multiple records
-        multi_tests = [
-            ("010100", "Start=1, Count=1"),
-            ("010500", "Start=1, Count=5"), 
-            ("000A00", "Start=0, Count=10"),
-            ("001E00", "Start=0, Count=30"),
-            ("000001", "Different pattern 1"),
-            ("000002", "Different pattern 2"),
-            ("010203", "Sequential bytes"),
-            ("FF0001", "High start, count 1"),
-        ]
-        
-        for params, description in multi_tests:
+        for description, encrypted in PHASE4_COMMANDS:
             history_responses.clear()
-            command = f"d1550a00{params}000000000000000000"
+            response_event.clear()
             print(f"Testing {description}: ", end="")
             
             try:
-                command_bytes = bytearray.fromhex(command)
-                encrypted = encrypt_bm6(command_bytes)
                 await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(2)  # Longer wait for multi-record responses
+                # Longer wait for multi-record responses
+                await wait_for_responses(response_event, MULTI_RECORD_TIMEOUT, MULTI_RECORD_QUIET_PERIOD)
                 
                 if history_responses:
                     print(f"{len(history_responses)} responses")
                     for i, resp in enumerate(history_responses):
                         analysis = resp['analysis']
                         if analysis and analysis['potential_values']:
-                            non_zero_values = [v for v in analysis['potential_values'] if v != 0]
+                            non_zero_values = analysis['non_zero_values']
                             if non_zero_values:
                                 print(f"    {i+1}: {non_zero_values}")
                                 # Look for voltage patterns
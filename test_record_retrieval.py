@@ -7,81 +7,60 @@
 import argparse
 import asyncio
 import time
-from Crypto.Cipher import AES
 from bleak import BleakClient
+from bm6_crypto import decrypt_bm6, encrypt_bm6
+from bm6_ble import supports_write_without_response, write_and_wait
+from bm6_parse import parse_voltage_data
 
-# BM6 encryption key
-BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+# Commands are answered with one packet; allow this long for stragglers
+# before moving on
+RESPONSE_QUIET_PERIOD = 0.1
 
-def decrypt_bm6(crypted):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.decrypt(crypted).hex()
+# Commands to test for data retrieval (based on patterns we've seen)
+DATA_COMMANDS = [
+    ("d1550b00000000000000000000000000", "Command 0B (next after 0A)"),
+    ("d1550800000000000000000000000000", "Command 08 (history variant)"),
+    ("d1550164000000000000000000000000", "Command 01 variant (gave unique response)"),
+    ("d1550200000000000000000000000000", "Command 02 (from earlier test)"),
+    ("d1550300000000000000000000000000", "Command 03 variant"),
+    ("d1550400000000000000000000000000", "Command 04 (might be read data)"),
+    ("d1550500000000000000000000000000", "Command 05 variant"),
+    ("d1550600000000000000000000000000", "Command 06 variant"),
+]
 
-def encrypt_bm6(plaintext):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.encrypt(plaintext)
+# Commands that might read the record at the current counter position
+READ_COMMANDS = [
+    ("d1550b00000000000000000000000000", "Read with 0B"),
+    ("d1550800000000000000000000000000", "Read with 08"),
+    ("d1550164000000000000000000000000", "Read with 01"),
+]
 
-def parse_voltage_data(hex_data):
-    """Try to parse hex data as voltage/temperature like standard BM6 format"""
-    if len(hex_data) < 18:
-        return None
-    
-    try:
-        # Standard BM6 voltage parsing
-        if hex_data.startswith('d15507'):
-            voltage = int(hex_data[15:18], 16) / 100.0
-            temp_flag = hex_data[6:8]
-            if temp_flag == "01":
-                temperature = -int(hex_data[8:10], 16)
-            else:
-                temperature = int(hex_data[8:10], 16)
-            soc = int(hex_data[12:14], 16) if len(hex_data) >= 14 else None
-            
-            return {
-                'voltage': voltage,
-                'temperature': temperature, 
-                'soc': soc,
-                'format': 'standard'
-            }
-        
-        # Try alternative voltage formats
-        voltage_candidates = []
-        for i in range(0, len(hex_data) - 4, 2):
-            try:
-                # Try 16-bit values that might be voltage * 100
-                val16 = int(hex_data[i:i+4], 16)
-                if 600 <= val16 <= 2000:  # 6.0V to 20.0V
-                    voltage_candidates.append({
-                        'position': i,
-                        'raw_value': val16,
-                        'voltage': val16 / 100.0
-                    })
-            except:
-                pass
-        
-        if voltage_candidates:
-            return {
-                'voltage_candidates': voltage_candidates,
-                'format': 'alternative'
-            }
-                
-    except Exception as e:
-        pass
-    
-    return None
+# The commands are constants, so encrypt them once at import
+ENCRYPTED_DATA_COMMANDS = [(encrypt_bm6(bytes.fromhex(command_hex)), command_hex, description)
+                           for command_hex, description in DATA_COMMANDS]
+ENCRYPTED_READ_COMMANDS = [(encrypt_bm6(bytes.fromhex(command_hex)), description)
+                           for command_hex, description in READ_COMMANDS]
+# Counter positions TEST 2 sets (0A with a position parameter) before reading
+COUNTER_POSITIONS = [0, 1, 5, 10, 20, 50]
+ENCRYPTED_SET_COMMANDS = {pos: encrypt_bm6(bytes.fromhex(f"d1550a00{pos:02x}0000000000000000000000"))
+                          for pos in COUNTER_POSITIONS}
+# Counter (0A) commands: reset to the first record, and step to the next one
+ENC_RESET = encrypt_bm6(bytes.fromhex("d1550a00000000000000000000000000"))
+ENC_INCREMENT = encrypt_bm6(bytes.fromhex("d1550a00010000000000000000000000"))
 
 async def test_record_retrieval(address):
     """Test commands that might retrieve actual record data"""
     
+    # Responses to the current command only; cleared before each command
     responses = []
+    response_event = asyncio.Event()
     
     async def notification_handler(sender, data):
         timestamp = time.time()
-        decrypted = decrypt_bm6(data)
+        decrypted = decrypt_bm6(data).hex()
         
         response_data = {
             'timestamp': timestamp,
-            'raw': data.hex(),
             'decrypted': decrypted
         }
         
@@ -91,6 +70,7 @@ async def test_record_retrieval(address):
             response_data['voltage_data'] = voltage_data
         
         responses.append(response_data)
+        response_event.set()
         
         # Print immediate analysis
         if voltage_data:
@@ -109,6 +89,9 @@ async def test_record_retrieval(address):
     async with BleakClient(address, timeout=30) as client:
         print(f"🔗 Connected to BM6 at {address}")
         await client.start_notify("FFF4", notification_handler)
+        # Read commands skip the write ack when the device allows it; counter
+        # (0A) commands always wait for it since the reads depend on them
+        read_ack = not supports_write_without_response(client)
         
         print("\n🎯 THEORY: 0A command increments counter, other commands read data")
         print("Testing data retrieval commands after setting counter position...\n")
@@ -116,28 +99,17 @@ async def test_record_retrieval(address):
         # Test 1: Reset counter and try reading
         print("📋 TEST 1: Reset counter and read data")
         
-        # Commands to test for data retrieval (based on patterns we've seen)
-        data_commands = [
-            ("d1550b00000000000000000000000000", "Command 0B (next after 0A)"),
-            ("d1550800000000000000000000000000", "Command 08 (history variant)"),
-            ("d1550164000000000000000000000000", "Command 01 variant (gave unique response)"),
-            ("d1550200000000000000000000000000", "Command 02 (from earlier test)"),
-            ("d1550300000000000000000000000000", "Command 03 variant"),
-            ("d1550400000000000000000000000000", "Command 04 (might be read data)"),
-            ("d1550500000000000000000000000000", "Command 05 variant"),
-            ("d1550600000000000000000000000000", "Command 06 variant"),
-        ]
-        
-        for command_hex, description in data_commands:
-            responses.clear()
+        # The next command goes out as soon as the current one is answered and
+        # RESPONSE_QUIET_PERIOD has passed without another packet
+        for encrypted, command_hex, description in ENCRYPTED_DATA_COMMANDS:
             print(f"\nTesting: {description}")
             print(f"Command: {command_hex}")
+            # Only this command's packets are counted
+            responses.clear()
             
             try:
-                command_bytes = bytearray.fromhex(command_hex)
-                encrypted = encrypt_bm6(command_bytes)
-                await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(2)
+                await write_and_wait(client, encrypted, response_event, 2, RESPONSE_QUIET_PERIOD,
+                                     response=read_ack)
                 
                 if responses:
                     print(f"📊 Got {len(responses)} response(s)")
@@ -153,55 +125,44 @@ async def test_record_retrieval(address):
         print("\n📋 TEST 2: Set counter position then read")
         
         # Set counter to specific positions and try reading
-        counter_positions = [0, 1, 5, 10, 20, 50]
-        
-        for pos in counter_positions:
+        for pos, enc_set in ENCRYPTED_SET_COMMANDS.items():
             print(f"\n🔄 Setting counter to position {pos}")
             responses.clear()
             
             # Send 0A command with parameter to set position
-            set_command = f"d1550a00{pos:02x}0000000000000000000000"
-            
             try:
-                command_bytes = bytearray.fromhex(set_command)
-                encrypted = encrypt_bm6(command_bytes)
-                await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(1)
+                await write_and_wait(client, enc_set, response_event, 1, RESPONSE_QUIET_PERIOD)
                 
                 # Now try to read data at this position
-                for read_cmd, desc in [
-                    ("d1550b00000000000000000000000000", "Read with 0B"),
-                    ("d1550800000000000000000000000000", "Read with 08"),
-                    ("d1550164000000000000000000000000", "Read with 01"),
-                ]:
+                for enc_read, desc in ENCRYPTED_READ_COMMANDS:
                     responses.clear()
-                    print(f"  📖 {desc}: ", end="")
+                    # The result row is printed in one call once the read is done
+                    row = [f"  📖 {desc}: "]
                     
                     try:
-                        cmd_bytes = bytearray.fromhex(read_cmd)
-                        encrypted = encrypt_bm6(cmd_bytes)
-                        await client.write_gatt_char("FFF3", encrypted, response=True)
-                        await asyncio.sleep(1)
+                        await write_and_wait(client, enc_read, response_event, 1, RESPONSE_QUIET_PERIOD,
+                                             response=read_ack)
                         
                         if responses:
                             resp = responses[0]
                             if 'voltage_data' in resp:
-                                print("VOLTAGE DATA FOUND! ⭐")
+                                row.append("VOLTAGE DATA FOUND! ⭐")
                                 vdata = resp['voltage_data']
                                 if vdata.get('format') == 'standard':
-                                    print(f"    {vdata['voltage']}V, {vdata['temperature']}°C")
+                                    row.append(f"\n    {vdata['voltage']}V, {vdata['temperature']}°C")
                             else:
                                 # Look for any non-standard patterns
                                 decrypted = resp['decrypted']
                                 if not decrypted.startswith('d15507') and not decrypted.startswith('d1550a'):
-                                    print(f"Different pattern: {decrypted[:20]}...")
+                                    row.append(f"Different pattern: {decrypted[:20]}...")
                                 else:
-                                    print("Standard/counter response")
+                                    row.append("Standard/counter response")
                         else:
-                            print("No response")
+                            row.append("No response")
                             
                     except Exception as e:
-                        print(f"Error: {e}")
+                        row.append(f"Error: {e}")
+                    print("".join(row))
                         
             except Exception as e:
                 print(f"❌ Failed to set position: {e}")
@@ -211,52 +172,39 @@ async def test_record_retrieval(address):
         
         # Set counter to beginning
         try:
-            reset_cmd = "d1550a00000000000000000000000000"
-            command_bytes = bytearray.fromhex(reset_cmd)
-            encrypted = encrypt_bm6(command_bytes)
-            await client.write_gatt_char("FFF3", encrypted, response=True)
-            await asyncio.sleep(1)
+            await write_and_wait(client, ENC_RESET, response_event, 1, RESPONSE_QUIET_PERIOD)
             
             print("Counter reset, now doing sequential reads...")
             
             # Try rapid sequential reads with different commands
-            read_commands = [
-                "d1550b00000000000000000000000000",
-                "d1550800000000000000000000000000", 
-                "d1550164000000000000000000000000"
-            ]
+            async def read_standard_voltage(encrypted):
+                """Send one read command and return its standard voltage reading, if any"""
+                responses.clear()
+                try:
+                    await write_and_wait(client, encrypted, response_event, 0.5,
+                                         RESPONSE_QUIET_PERIOD, response=read_ack)
+                except Exception:
+                    return None
+                if responses:
+                    vdata = responses[0].get('voltage_data')
+                    if vdata and vdata.get('format') == 'standard':
+                        return vdata
+                return None
             
             for i in range(10):  # Read 10 records
                 print(f"\n📖 Sequential read {i+1}:")
                 
-                for cmd_hex in read_commands:
-                    responses.clear()
-                    
-                    try:
-                        command_bytes = bytearray.fromhex(cmd_hex)
-                        encrypted = encrypt_bm6(command_bytes)
-                        await client.write_gatt_char("FFF3", encrypted, response=True)
-                        await asyncio.sleep(0.5)
-                        
-                        if responses and len(responses) > 0:
-                            resp = responses[0]
-                            if 'voltage_data' in resp:
-                                vdata = resp['voltage_data']
-                                if vdata.get('format') == 'standard':
-                                    print(f"  🔋 {vdata['voltage']}V, {vdata['temperature']}°C")
-                                    # This would be historical data!
-                                    break
-                        
-                    except Exception as e:
-                        continue
+                # Always 0B, 08, 01 in that order; stop at the first reading
+                for encrypted, _ in ENCRYPTED_READ_COMMANDS:
+                    vdata = await read_standard_voltage(encrypted)
+                    if vdata:
+                        # This would be historical data!
+                        print(f"  🔋 {vdata['voltage']}V, {vdata['temperature']}°C")
+                        break
                         
                 # Increment counter for next record
                 try:
-                    inc_cmd = "d1550a00010000000000000000000000"
-                    command_bytes = bytearray.fromhex(inc_cmd)
-                    encrypted = encrypt_bm6(command_bytes)
-                    await client.write_gatt_char("FFF3", encrypted, response=True)
-                    await asyncio.sleep(0.2)
+                    await write_and_wait(client, ENC_INCREMENT, response_event, 0.2, RESPONSE_QUIET_PERIOD)
                 except:
                     pass
                         
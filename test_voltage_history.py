@@ -6,99 +6,49 @@
 
 import argparse
 import asyncio
+import functools
 import time
 from datetime import datetime
-from Crypto.Cipher import AES
 from bleak import BleakClient
+from bm6_crypto import decrypt_bm6, encrypt_bm6
+from bm6_ble import supports_write_without_response, write_and_wait
+from bm6_parse import parse_response_detailed, quick_parse
 
-# BM6 encryption key
-BM6_KEY = bytearray([108, 101, 97, 103, 101, 110, 100, 255, 254, 48, 49, 48, 48, 48, 48, 57])
+# How long to wait for further packets once a command has been answered;
+# command 05 sends several responses, the others usually one
+RESPONSE_QUIET_PERIOD = 0.1
+MULTI_RESPONSE_QUIET_PERIOD = 0.5
 
-def decrypt_bm6(crypted):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.decrypt(crypted).hex()
+@functools.lru_cache(maxsize=None) # Commands repeat across loops; AES output is deterministic
+def encrypt_command(command_hex):
+    """Encrypt a hex command string, reusing the result for repeated commands"""
+    return encrypt_bm6(bytes.fromhex(command_hex))
 
-def encrypt_bm6(plaintext):
-    cipher = AES.new(BM6_KEY, AES.MODE_CBC, 16 * b'\0')
-    return cipher.encrypt(plaintext)
+async def test_voltage_history(address, debug=False):
+    """Deep dive testing of commands 03 and 05 for voltage history
 
-def find_voltage_values(hex_data):
-    """Find all potential voltage values in hex data"""
-    voltage_candidates = []
-    
-    # Check every 2-byte position for voltage-like values
-    for i in range(0, len(hex_data) - 3, 2):
-        try:
-            # Try big-endian 16-bit
-            val16_be = int(hex_data[i:i+4], 16)
-            if 600 <= val16_be <= 2000:  # 6.0V to 20.0V
-                voltage_candidates.append({
-                    'position': i,
-                    'raw_value': val16_be,
-                    'voltage': val16_be / 100.0,
-                    'bytes': hex_data[i:i+4],
-                    'endian': 'big'
-                })
-            
-            # Try little-endian 16-bit
-            if i + 4 <= len(hex_data):
-                val16_le = int(hex_data[i+2:i+4] + hex_data[i:i+2], 16)
-                if 600 <= val16_le <= 2000:
-                    voltage_candidates.append({
-                        'position': i,
-                        'raw_value': val16_le,
-                        'voltage': val16_le / 100.0,
-                        'bytes': hex_data[i:i+4],
-                        'endian': 'little'
-                    })
-        except:
-            continue
-    
-    return voltage_candidates
-
-def parse_response_detailed(hex_data):
-    """Detailed parsing of response data"""
-    analysis = {
-        'length': len(hex_data),
-        'prefix': hex_data[:8] if len(hex_data) >= 8 else hex_data,
-        'full_data': hex_data,
-        'voltage_candidates': find_voltage_values(hex_data),
-        'byte_analysis': []
-    }
-    
-    # Analyze individual bytes
-    for i in range(0, min(len(hex_data), 32), 2):
-        if i + 2 <= len(hex_data):
-            byte_val = int(hex_data[i:i+2], 16)
-            analysis['byte_analysis'].append({
-                'position': i,
-                'hex': hex_data[i:i+2],
-                'decimal': byte_val,
-                'ascii': chr(byte_val) if 32 <= byte_val <= 126 else '.'
-            })
-    
-    return analysis
-
-async def test_voltage_history(address):
-    """Deep dive testing of commands 03 and 05 for voltage history"""
+    The full per-byte analysis of each response is only built with debug set.
+    """
+    parse_response = parse_response_detailed if debug else quick_parse
     
     all_history_data = []
+    response_event = asyncio.Event()
     
     async def notification_handler(sender, data):
         timestamp = time.time()
-        decrypted = decrypt_bm6(data)
+        decrypted = decrypt_bm6(data).hex()
         
-        analysis = parse_response_detailed(decrypted)
+        analysis = parse_response(decrypted)
         
         record = {
             'timestamp': timestamp,
             'datetime': datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f')[:-3],
-            'raw': data.hex(),
             'decrypted': decrypted,
             'analysis': analysis
         }
         
         all_history_data.append(record)
+        response_event.set()
         
         # Print voltage findings immediately
         if analysis['voltage_candidates']:
@@ -110,6 +60,8 @@ async def test_voltage_history(address):
     async with BleakClient(address, timeout=30) as client:
         print(f"🔗 Connected to BM6 at {address}")
         await client.start_notify("FFF4", notification_handler)
+        # Skip the write ack when the device allows it
+        ack = not supports_write_without_response(client)
         
         print("🎯 DEEP DIVE: Commands 03 & 05 showed voltage data")
         print("Systematic testing to extract all historical records...\n")
@@ -121,28 +73,29 @@ async def test_voltage_history(address):
         for param in range(0, 20):
             all_history_data.clear()
             command = f"d155030{param:01x}000000000000000000000000"
-            print(f"\nParam 0{param:01x}: ", end="")
+            # Each result row is printed in one call once the command is done
+            row = [f"\nParam 0{param:01x}: "]
             
             try:
-                command_bytes = bytearray.fromhex(command)
-                encrypted = encrypt_bm6(command_bytes)
-                await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(1.5)
+                encrypted = encrypt_command(command)
+                await write_and_wait(client, encrypted, response_event, 1.5, RESPONSE_QUIET_PERIOD,
+                                     response=ack)
                 
                 if all_history_data:
                     voltage_records = [r for r in all_history_data if r['analysis']['voltage_candidates']]
                     if voltage_records:
-                        print(f"✅ {len(voltage_records)} voltage record(s)")
+                        row.append(f"✅ {len(voltage_records)} voltage record(s)")
                         for vr in voltage_records:
                             for vc in vr['analysis']['voltage_candidates']:
-                                print(f"    {vc['voltage']}V at pos {vc['position']} ({vc['bytes']})")
+                                row.append(f"\n    {vc['voltage']}V at pos {vc['position']} ({vc['bytes']})")
                     else:
-                        print(f"{len(all_history_data)} response(s), no voltage")
+                        row.append(f"{len(all_history_data)} response(s), no voltage")
                 else:
-                    print("No response")
+                    row.append("No response")
                     
             except Exception as e:
-                print(f"Error: {e}")
+                row.append(f"Error: {e}")
+            print("".join(row))
         
         # Test 2: Command 05 with various parameters
         print(f"\n📋 TEST 2: Command 05 Variations")
@@ -151,28 +104,29 @@ async def test_voltage_history(address):
         for param in range(0, 20):
             all_history_data.clear()
             command = f"d155050{param:01x}000000000000000000000000"
-            print(f"\nParam 0{param:01x}: ", end="")
+            row = [f"\nParam 0{param:01x}: "]
             
             try:
-                command_bytes = bytearray.fromhex(command)
-                encrypted = encrypt_bm6(command_bytes)
-                await client.write_gatt_char("FFF3", encrypted, response=True)
-                await asyncio.sleep(2)  # Longer wait since 05 gave multiple responses
+                encrypted = encrypt_command(command)
+                # Longer wait since 05 gave multiple responses
+                await write_and_wait(client, encrypted, response_event, 2,
+                                     MULTI_RESPONSE_QUIET_PERIOD, response=ack)
                 
                 if all_history_data:
                     voltage_records = [r for r in all_history_data if r['analysis']['voltage_candidates']]
                     if voltage_records:
-                        print(f"✅ {len(voltage_records)} voltage record(s) of {len(all_history_data)} total")
+                        row.append(f"✅ {len(voltage_records)} voltage record(s) of {len(all_history_data)} total")
                         for i, vr in enumerate(voltage_records):
                             for vc in vr['analysis']['voltage_candidates']:
-                                print(f"    #{i+1}: {vc['voltage']}V at pos {vc['position']} ({vc['bytes']})")
+                                row.append(f"\n    #{i+1}: {vc['voltage']}V at pos {vc['position']} ({vc['bytes']})")
                     else:
-                        print(f"{len(all_history_data)} response(s), no voltage")
+                        row.append(f"{len(all_history_data)} response(s), no voltage")
                 else:
-                    print("No response")
+                    row.append("No response")
                     
             except Exception as e:
-                print(f"Error: {e}")
+                row.append(f"Error: {e}")
+            print("".join(row))
         
         # Test 3: Extended parameter testing
         print(f"\n📋 TEST 3: Extended Parameter Testing")
@@ -193,29 +147,29 @@ async def test_voltage_history(address):
                 
                 for endian, param_hex in [('LE', param_le), ('BE', param_be)]:
                     command = f"d155{cmd}00{param_hex}00000000000000000000"
-                    print(f"  0x{param_val:02x}({endian}): ", end="")
+                    label = f"  0x{param_val:02x}({endian}): "
                     
                     try:
-                        command_bytes = bytearray.fromhex(command)
-                        encrypted = encrypt_bm6(command_bytes)
-                        await client.write_gatt_char("FFF3", encrypted, response=True)
-                        await asyncio.sleep(1.5)
+                        encrypted = encrypt_command(command)
+                        quiet_period = MULTI_RESPONSE_QUIET_PERIOD if cmd == '05' else RESPONSE_QUIET_PERIOD
+                        await write_and_wait(client, encrypted, response_event, 1.5, quiet_period,
+                                             response=ack)
                         
                         voltage_count = sum(1 for r in all_history_data if r['analysis']['voltage_candidates'])
                         total_count = len(all_history_data)
                         
                         if voltage_count > 0:
-                            print(f"✅ {voltage_count}/{total_count} voltage")
+                            print(f"{label}✅ {voltage_count}/{total_count} voltage")
                             promising_commands.append({
                                 'command': command,
                                 'voltage_records': voltage_count,
                                 'total_records': total_count
                             })
                         else:
-                            print(f"{total_count} resp" if total_count > 0 else "none")
+                            print(f"{label}{total_count} resp" if total_count > 0 else f"{label}none")
                             
                     except Exception as e:
-                        print("err")
+                        print(f"{label}err")
         
         # Test 4: Systematic record extraction
         print(f"\n📋 TEST 4: Systematic Record Extraction")
@@ -228,20 +182,20 @@ async def test_voltage_history(address):
             print(f"\nExtracting multiple records with incremental parameters:")
             
             historical_voltages = []
+            extract_quiet_period = (MULTI_RESPONSE_QUIET_PERIOD if best_cmd['command'][4:6] == '05'
+                                    else RESPONSE_QUIET_PERIOD)
             
-            for i in range(50):  # Try to get 50 historical records
+            # Use the best command with incremental parameter, encrypted up front
+            base_cmd = best_cmd['command'][:8]  # d155XX00
+            encrypted_cmds = [encrypt_command(f"{base_cmd}{i:04x}00000000000000000000")
+                              for i in range(50)]  # Try to get 50 historical records
+            
+            for i, encrypted in enumerate(encrypted_cmds):
                 all_history_data.clear()
                 
-                # Use the best command with incremental parameter
-                base_cmd = best_cmd['command'][:12]  # d155XX00
-                param_hex = f"{i:04x}"
-                command = f"{base_cmd}{param_hex}000000000000000000"
-                
                 try:
-                    command_bytes = bytearray.fromhex(command)
-                    encrypted = encrypt_bm6(command_bytes)
-                    await client.write_gatt_char("FFF3", encrypted, response=True)
-                    await asyncio.sleep(1)
+                    await write_and_wait(client, encrypted, response_event, 1, extract_quiet_period,
+                                         response=ack)
                     
                     for record in all_history_data:
                         for vc in record['analysis']['voltage_candidates']:
@@ -294,6 +248,7 @@ async def test_voltage_history(address):
 async def main():
     parser = argparse.ArgumentParser(description='BM6 Voltage History Deep Dive')
     parser.add_argument('--address', type=str, required=True, help='BM6 device address')
+    parser.add_argument('--debug', action='store_true', help='Keep the full byte analysis of every response')
     
     args = parser.parse_args()
     
@@ -301,7 +256,7 @@ async def main():
     print("Focus on commands 03 & 05 which showed voltage data")
     print("Systematic extraction of historical records...\n")
     
-    await test_voltage_history(args.address)
+    await test_voltage_history(args.address, args.debug)
 
 if __name__ == "__main__":
     asyncio.run(main())